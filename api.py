@@ -1,42 +1,96 @@
-from flask import Flask, jsonify, request
-from database import DatabaseManager
+import asyncio
+import time
+import metrics
+from quart import Quart, Response, g, jsonify, request
+from async_database import AsyncDatabaseManager
+from notifier import Notifier
 import hashlib
-import requests
+import json
+
+# Upper bound for ?limit= on /pending
+PENDING_PAGE_MAX = 1000
+
+# Upper bound for the ids list of batch /approve and /remove
+BATCH_MAX = 1000
 
 
 class API:
-    def __init__(self, token: str, db: DatabaseManager):
-        self.app = Flask("telegram_flashback_api")
+    # ASGI app: every route is a coroutine on one event loop, so requests waiting on Postgres or Telegram
+    # don't hold a worker thread each. Run it with run(), or mount self.app in any ASGI server
+    def __init__(self, token: str, db: AsyncDatabaseManager, bot_api_url="https://api.telegram.org"):
+        self.app = Quart("telegram_flashback_api")
         self.db = db
         self.token = token
+        self.notifier = Notifier(token, db, base_url=bot_api_url)
 
         # Manually set routes up
         self.app.route('/pending', methods=['GET'])(self.pending)
         self.app.route('/approve/<int:id>', methods=['POST'])(self.approve)
         self.app.route('/remove/<int:id>', methods=['POST'])(self.remove)
+        self.app.route('/approve', methods=['POST'])(self.approve_batch)
+        self.app.route('/remove', methods=['POST'])(self.remove_batch)
         self.app.route('/lastkey', methods=['GET'])(self.lastkey)
-
-    def send_message(self, chat_id, text):
-        base_url = f"https://api.telegram.org/bot{self.token}/sendMessage"
-        params = {
-            'chat_id': chat_id,
-            'text': text,
-        }
-
-        response = requests.post(base_url, params=params)
-        result = response.json()
-        if not result['ok']:
-            print(f"Failed to send message. Telegram API response: {result}")
-
-    def lastkey(self):
-        md5 = self.db.get_last_md5()
+        self.app.route('/verify', methods=['GET'])(self.verify)
+        self.app.route('/metrics', methods=['GET'])(self.export_metrics)
+        self.app.route('/debug/db', methods=['GET'])(self.debug_db)
+
+        # Database, listener and notifier live on the server's event loop
+        self.app.before_serving(self.startup)
+        self.app.after_serving(self.shutdown)
+
+        # Request latency per route
+        self.app.before_request(self.start_timer)
+        self.app.after_request(self.observe_request)
+        metrics.watch_database(self.db)
+
+    async def startup(self):
+        await self.db.connect()
+        self.db.start_listener()
+        self.notifier.start()
+
+    async def shutdown(self):
+        await self.notifier.stop()
+        await self.db.close()
+
+    async def start_timer(self):
+        g.request_start = time.perf_counter()
+
+    async def observe_request(self, response):
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.API_REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, route=route, status=response.status_code)
+        return response
+
+    # Prometheus scrape endpoint
+    async def export_metrics(self):
+        metrics.OUTBOX_DEPTH.set(await self.db.count_messages())
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+    # Messages go through the outbox, written in the same transaction as the move, and are delivered by the
+    # notifier task. Phones without a chat get no message
+    @staticmethod
+    def approved_messages(applied):
+        messages = []
+        for snd_phone, recv_phone, amount in applied.values():
+            messages.append((snd_phone, f"Заявка на передачу BCR одобрена. Вы отправили {amount} BCR пользователю {recv_phone}. Не забудьте оплатить налог самозанятого с потраченной суммы!"))
+            messages.append((recv_phone, f"Вы получили {amount} BCR от пользователя {snd_phone}"))
+        return messages
+
+    @staticmethod
+    def removed_messages(removed):
+        return [
+            (recv_phone, f"Заявка на передачу {amount} BCR, пользователю {recv_phone} отклонена")
+            for recv_phone, amount in removed.values()
+        ]
+
+    async def lastkey(self):
+        md5 = await self.db.get_last_md5()
         if md5:
             return md5[0]
         else:
             return "NO", 200
 
     async def auth(self, received_md5):
-        latest_md5 = self.db.get_last_md5()
+        latest_md5 = await self.db.get_last_md5()
 
         if not received_md5:
             return None
@@ -51,61 +105,138 @@ class API:
         else:
             return None
 
+    @staticmethod
+    def pending_json(action):
+        return {
+            'id': action[0],
+            'sender_phone': action[1],
+            'receiver_phone': action[2],
+            'amount': action[3],
+            'comment': action[4],
+            'less_than_zero': action[6],
+        }
+
     # Return pending actions
+    # ?after_id=<last seen id>&limit=<n> pages through the queue, ?format=ndjson streams it one object per line
     async def pending(self):
         md5 = await self.auth(request.args.get('md5'))
         if not md5:
             return jsonify({'error': 'Failed to authenticate'}), 401
 
-        pending_actions = self.db.get_all_pending_actions()
+        after_id = request.args.get('after_id', 0, type=int)
+        limit = request.args.get('limit', type=int)
+        if limit is not None and not 0 < limit <= PENDING_PAGE_MAX:
+            return jsonify({'error': f'limit must be between 1 and {PENDING_PAGE_MAX}'}), 400
+
+        if request.args.get('format') == 'ndjson':
+            async def generate():
+                rows = self.db.iter_pending_actions_with_balance(after_id, limit=limit)
+                try:
+                    async for action in rows:
+                        yield json.dumps(self.pending_json(action), ensure_ascii=False) + '\n'
+                finally:
+                    # Hands the pooled connection back as soon as the response ends, client gone or not
+                    await rows.aclose()
+            return Response(generate(), mimetype='application/x-ndjson')
+
         result = []
-        for action in pending_actions:
-            balance = self.db.get_balance(action[1])
-            ltz = balance[0] < action[3]
-            result.append({
-                'id': action[0],
-                'sender_phone': action[1],
-                'receiver_phone': action[2],
-                'amount': action[3],
-                'comment': action[4],
-                'less_than_zero': ltz,
-            })
+        for action in await self.db.get_pending_actions_with_balance(after_id, limit):
+            result.append(self.pending_json(action))
         return jsonify(result)
 
     # Move pending action to a db with correct md5
     async def approve(self, id):
-        md5 = await self.auth(request.json.get('md5'))
+        md5 = await self.auth((await request.get_json()).get('md5'))
         if not md5:
             return jsonify({'error': 'Failed to authenticate'}), 401
 
-        dbres = self.db.apply_pending_action(id, md5)
+        dbres = await self.db.apply_pending_action(id, md5, self.approved_messages)
 
         if not (dbres == None):
-            # Send message
-            snd_phone, recv_phone, amount = dbres
-            snd_id = self.db.get_reverse_assoc(snd_phone)[0]
-            recv_id = self.db.get_reverse_assoc(recv_phone)[0]
-            self.send_message(snd_id, f"Заявка на передачу BCR одобрена. Вы отправили {amount} BCR пользователю {recv_phone}. Не забудьте оплатить налог самозанятого с потраченной суммы!")
-            self.send_message(recv_id, f"Вы получили {amount} BCR от пользователя {snd_phone}")
+            self.notifier.wake()
             return jsonify({'message': 'Action moved to actions successfully'})
         else:
             return jsonify({'error': 'Action ID not found'}), 400
 
     # Remove a pending action
     async def remove(self, id):
-        md5 = await self.auth(request.json.get('md5'))
+        md5 = await self.auth((await request.get_json()).get('md5'))
         if not md5:
             return jsonify({'error': 'Failed to authenticate'}), 401
-        result = self.db.remove_pending_action(id)
+        result = await self.db.remove_pending_action(id, self.removed_messages)
         if result:
-            # Send message
-            recv_phone, amount = result
-            snd_id = self.db.get_reverse_assoc(recv_phone)[0]
-            self.send_message(snd_id, f"Заявка на передачу {amount} BCR, пользователю {recv_phone} отклонена")
+            self.notifier.wake()
             return jsonify({'message': 'Action removed successfully'})
         else:
             return jsonify({'error': 'Action ID not found'}), 400
 
-    def run(self):
-        from waitress import serve
-        serve(self.app, host="0.0.0.0", port=5000)
+    @staticmethod
+    def batch_ids(body):
+        ids = body.get('ids')
+        if not isinstance(ids, list) or not 0 < len(ids) <= BATCH_MAX:
+            return None
+        if not all(isinstance(id, int) and not isinstance(id, bool) for id in ids):
+            return None
+        return ids
+
+    # Approve a list of pending actions in one transaction, {"md5": ..., "ids": [...]}
+    # The whole batch is recorded under the given md5
+    async def approve_batch(self):
+        body = await request.get_json(silent=True) or {}
+        md5 = await self.auth(body.get('md5'))
+        if not md5:
+            return jsonify({'error': 'Failed to authenticate'}), 401
+        ids = self.batch_ids(body)
+        if ids is None:
+            return jsonify({'error': f'ids must be a list of 1 to {BATCH_MAX} integers'}), 400
+
+        applied = await self.db.apply_pending_actions(ids, md5, self.approved_messages)
+        if applied:
+            self.notifier.wake()
+
+        return jsonify({'results': [{'id': id, 'status': 'approved' if id in applied else 'not_found'} for id in ids]})
+
+    # Remove a list of pending actions in one transaction, {"md5": ..., "ids": [...]}
+    async def remove_batch(self):
+        body = await request.get_json(silent=True) or {}
+        md5 = await self.auth(body.get('md5'))
+        if not md5:
+            return jsonify({'error': 'Failed to authenticate'}), 401
+        ids = self.batch_ids(body)
+        if ids is None:
+            return jsonify({'error': f'ids must be a list of 1 to {BATCH_MAX} integers'}), 400
+
+        removed = await self.db.remove_pending_actions(ids, self.removed_messages)
+        if removed:
+            self.notifier.wake()
+
+        return jsonify({'results': [{'id': id, 'status': 'removed' if id in removed else 'not_found'} for id in ids]})
+
+    # Verify the hash chain of actions added since the last verification
+    async def verify(self):
+        md5 = await self.auth(request.args.get('md5'))
+        if not md5:
+            return jsonify({'error': 'Failed to authenticate'}), 401
+        result = await self.db.verify_chain()
+        return jsonify({**result, 'ok': result['broken_at'] is None})
+
+    # Database profile report, needs AsyncDatabaseManager(profiler=QueryProfiler(...))
+    async def debug_db(self):
+        md5 = await self.auth(request.args.get('md5'))
+        if not md5:
+            return jsonify({'error': 'Failed to authenticate'}), 401
+        if self.db.profiler is None:
+            return jsonify({'error': 'Profiling is disabled'}), 404
+        return jsonify({**self.db.profiler.report(request.args.get('limit', 50, type=int)), 'pool': self.db.pool_stats()})
+
+    def run(self, host="0.0.0.0", port=5000):
+        asyncio.run(self.serve(host, port))
+
+    async def serve(self, host="0.0.0.0", port=5000, shutdown_trigger=None):
+        # Hypercorn on the current loop, until shutdown_trigger returns (SIGINT/SIGTERM by default)
+        from hypercorn.asyncio import serve
+        from hypercorn.config import Config
+        config = Config()
+        config.bind = [f"{host}:{port}"]
+        config.accesslog = None
+        await serve(self.app, config, shutdown_trigger=shutdown_trigger)
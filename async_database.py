@@ -0,0 +1,473 @@
+import asyncio
+import hashlib
+import logging
+import random
+import time
+import psycopg
+import psycopg.errors
+from contextlib import asynccontextmanager
+from cache import LRUCache
+from metrics import DB_QUERY_SECONDS, DB_WAIT_SECONDS, current_method, timed
+from psycopg.types.json import Jsonb
+from psycopg_pool import AsyncConnectionPool
+from queries import (
+    APPLY_PENDING_ACTIONS, APPLY_RETRIES, CHAIN_BATCH, CLAIM_CHECKPOINT, ENQUEUE_FOR_PHONES, LOCK_CHECKPOINT, LOCK_TRANSFER_USERS, PENDING_WITH_BALANCE,
+    SAVE_CHECKPOINT,
+)
+from schema import BOOTSTRAP_LOCK, MIGRATIONS, TABLES
+
+logger = logging.getLogger(__name__)
+
+# Per-method latency, see metrics.py
+db_timed = timed(DB_QUERY_SECONDS, "method", method=True)
+
+class AsyncDatabaseManager:
+    # Awaitable twin of DatabaseManager for asyncio code (the bot and the API), same methods and return shapes.
+    # Only this one keeps the LISTEN-backed chain head and balance caches, the sync one serves maintenance scripts
+    def __init__(self, db_params={'host': 'your_host', 'database': 'your_database', 'user': 'your_user', 'password': 'your_password', 'port': 'your_port'}, pool_min=1, pool_max=10, assoc_cache_size=10000, balance_cache_size=10000, profiler=None):
+        # libpq calls the database "dbname", psycopg2 accepts both
+        self.db_params = dict(db_params)
+        if 'database' in self.db_params:
+            self.db_params['dbname'] = self.db_params.pop('database')
+        self.pool_min = pool_min
+        self.pool_max = pool_max
+        self.pool = None
+        self.profiler = profiler
+
+        # Cached (id, md5) of the newest actions row, only trusted while the listener is connected
+        self._head = None
+        self._head_generation = 0
+        self._listening = False
+        self._listener = None
+        self._channels = {'actions_head': self._on_actions_head, 'balances': self._on_balances}
+
+        # Pool counters, see pool_stats()
+        self._checkouts = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+
+        # Telegram id <-> phone associations never change once added, so both directions are cached.
+        # Only hits are stored: an unknown user may register from the other process at any time
+        self._assoc_cache = LRUCache(assoc_cache_size)
+        self._reverse_assoc_cache = LRUCache(assoc_cache_size)
+
+        # Balances by phone, only trusted while the listener is connected. Every balance change is announced
+        # on the 'balances' channel, and transfers made here also drop their phones right away
+        self._balance_cache = LRUCache(balance_cache_size)
+
+    async def connect(self):
+        # The pool is bound to the running event loop, so it is opened from inside it. Connecting twice is a no-op
+        if self.pool is not None:
+            return
+        kwargs = dict(self.db_params)
+        if self.profiler is not None:
+            # Opt-in statement timing, see profiler.QueryProfiler
+            kwargs['cursor_factory'] = self.profiler.async_cursor_factory()
+        self.pool = AsyncConnectionPool(kwargs=kwargs, min_size=self.pool_min, max_size=self.pool_max, open=False)
+        await self.pool.open()
+
+        async with self._cursor() as cursor:
+            await cursor.execute('SELECT pg_advisory_xact_lock(%s)', (BOOTSTRAP_LOCK,))
+            for statement in TABLES:
+                await cursor.execute(statement)
+
+            # Bring existing deployments up to date
+            await cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+            current_version = (await cursor.fetchone())[0]
+            for version, statements in MIGRATIONS:
+                if version > current_version:
+                    for statement in statements:
+                        await cursor.execute(statement)
+                    await cursor.execute('INSERT INTO schema_version (version) VALUES (%s)', (version,))
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                # Whatever ended the listener, the pool still has to close
+                logger.exception("Database listener failed")
+            self._listener = None
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    @asynccontextmanager
+    async def _cursor(self, name=None):
+        # One connection and cursor per call, committed on success and rolled back on error. A name makes it a server-side cursor
+        start = time.perf_counter()
+        async with self.pool.connection() as conn:
+            acquired = time.perf_counter()
+            self._record_checkout(acquired - start)
+            try:
+                async with conn.cursor(name=name) if name else conn.cursor() as cursor:
+                    yield cursor
+            finally:
+                if self.profiler is not None:
+                    self.profiler.record_hold(time.perf_counter() - acquired)
+
+    def _record_checkout(self, waited):
+        DB_WAIT_SECONDS.observe(waited, method=current_method.get())
+        # Only touched from the event loop thread, no lock needed
+        self._checkouts += 1
+        self._wait_time += waited
+        self._max_wait_time = max(self._max_wait_time, waited)
+
+    def pool_stats(self):
+        # Checkout counters, wait times are in seconds
+        return {
+            'pooled': True,
+            'checkouts': self._checkouts,
+            'wait_time': self._wait_time,
+            'max_wait_time': self._max_wait_time,
+            'avg_wait_time': self._wait_time / self._checkouts if self._checkouts else 0.0,
+        }
+
+    def start_listener(self):
+        # LISTEN for changes made by any process and keep in-process caches up to date. Needs the running loop
+        self._listener = asyncio.create_task(self._listen())
+
+    async def _listen(self):
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(**self.db_params, autocommit=True) as conn:
+                    for channel in self._channels:
+                        await conn.execute(f'LISTEN {channel}')
+                    self._set_listening(True)
+                    try:
+                        async for notify in conn.notifies():
+                            self._dispatch(notify.channel, notify.payload)
+                    finally:
+                        # Notifications may have been missed, stop trusting the caches until reconnected
+                        self._set_listening(False)
+            except psycopg.Error:
+                logger.exception("Database listener disconnected")
+                await asyncio.sleep(5)
+
+    def _dispatch(self, channel, payload):
+        # A notification that can't be handled must not end the listener. Its news is lost, so the caches start over
+        try:
+            self._channels[channel](payload)
+        except Exception:
+            logger.exception("Bad notification on %s: %r", channel, payload)
+            self._set_listening(True)
+
+    def _set_listening(self, listening):
+        self._listening = listening
+        self._head = None
+        self._head_generation += 1
+        self._balance_cache.clear()
+
+    def _on_actions_head(self, payload):
+        id, sep, md5 = payload.partition(':')
+        if not sep or not id.isdigit():
+            logger.warning("Ignoring malformed actions_head payload %r", payload)
+            return
+        self._update_head(int(id), md5)
+
+    def _on_balances(self, payload):
+        for phone_number in payload.split(','):
+            self._balance_cache.invalidate(phone_number)
+
+    def _update_head(self, id, md5):
+        # The head is the row with the highest id, whatever order the news arrives in.
+        # An unloaded head stays unloaded, the next get_last_md5() reads it from the table. The generation moves
+        # either way, so a load already in flight doesn't store a head older than this one
+        self._head_generation += 1
+        if self._head is not None and id > self._head[0]:
+            self._head = (id, md5)
+
+    @db_timed
+    async def add_user(self, phone_number):
+        # Self-explanatory
+        async with self._cursor() as cursor:
+            await cursor.execute('INSERT INTO users (phone_number, balance) VALUES (%s, 0) ON CONFLICT (phone_number) DO NOTHING', (phone_number,))
+
+    @db_timed
+    async def get_user(self, phone_number):
+        # Self-explanatory
+        async with self._cursor() as cursor:
+            await cursor.execute('SELECT * FROM users WHERE phone_number=%s', (phone_number,))
+            return await cursor.fetchone()
+
+    @db_timed
+    async def add_assoc(self, user_id, phone_number):
+        async with self._cursor() as cursor:
+            # Add association between telegram user id and a phone number
+            await cursor.execute('INSERT INTO assoc (user_id, phone_number) VALUES (%s, %s)', (user_id, phone_number))
+        self._assoc_cache.put(user_id, (phone_number,))
+        self._reverse_assoc_cache.setdefault(phone_number, (user_id,))
+
+    @db_timed
+    async def get_assoc(self, user_id):
+        row = self._assoc_cache.get(user_id)
+        if row is not None:
+            return row
+        async with self._cursor() as cursor:
+            # Self-explanatory
+            await cursor.execute('SELECT phone_number FROM assoc WHERE user_id=%s', (user_id,))
+            row = await cursor.fetchone()
+        if row is not None:
+            self._assoc_cache.put(user_id, row)
+        return row
+
+    @db_timed
+    async def get_reverse_assoc(self, phone_number):
+        row = self._reverse_assoc_cache.get(phone_number)
+        if row is not None:
+            return row
+        async with self._cursor() as cursor:
+            # Self-explanatory
+            await cursor.execute('SELECT user_id FROM assoc WHERE phone_number=%s', (phone_number,))
+            row = await cursor.fetchone()
+        if row is not None:
+            row = self._reverse_assoc_cache.setdefault(phone_number, row)
+        return row
+
+    def assoc_cache_stats(self):
+        return {'assoc': self._assoc_cache.stats(), 'reverse_assoc': self._reverse_assoc_cache.stats()}
+
+    def balance_cache_stats(self):
+        return self._balance_cache.stats()
+
+    @db_timed
+    async def get_balance(self, phone_number):
+        # Served from memory while the listener is connected, see start_listener()
+        if not self._listening:
+            async with self._cursor() as cursor:
+                await cursor.execute('SELECT balance FROM users WHERE phone_number=%s', (phone_number,))
+                return await cursor.fetchone()
+
+        row = self._balance_cache.get(phone_number)
+        if isinstance(row, tuple):
+            return row
+        # Marks the load, an invalidation while querying removes it and the result isn't cached
+        loading = object()
+        self._balance_cache.put(phone_number, loading)
+        row = None
+        try:
+            async with self._cursor() as cursor:
+                await cursor.execute('SELECT balance FROM users WHERE phone_number=%s', (phone_number,))
+                row = await cursor.fetchone()
+        finally:
+            # Unknown phones aren't cached, users are added without a notification
+            self._balance_cache.replace(phone_number, loading, row)
+        return row
+
+    @db_timed
+    async def get_all_pending_actions(self):
+        async with self._cursor() as cursor:
+            await cursor.execute('SELECT * FROM pending_actions')
+            return await cursor.fetchall()
+
+    @db_timed
+    async def get_pending_actions_with_balance(self, after_id=0, limit=None):
+        # Pending actions with the sender's balance and whether the transfer would overdraw it, in one round-trip.
+        # Keyset paginated: pass the last seen id as after_id, limit=None returns everything
+        async with self._cursor() as cursor:
+            await cursor.execute(PENDING_WITH_BALANCE + ' LIMIT %s', (after_id, limit))
+            return await cursor.fetchall()
+
+    async def iter_pending_actions_with_balance(self, after_id=0, batch_size=1000, limit=None):
+        # Same rows, streamed from a server-side cursor batch_size rows at a time, at most limit of them.
+        # Holds a connection until exhausted or closed
+        async with self._cursor(name='pending_actions_stream') as cursor:
+            cursor.itersize = batch_size
+            await cursor.execute(PENDING_WITH_BALANCE + ' LIMIT %s', (after_id, limit))
+            async for row in cursor:
+                yield row
+
+    @db_timed
+    async def create_pending_action(self, user_phone_number, receiver_phone_number, amount, comment):
+        # Self-explanatory
+        async with self._cursor() as cursor:
+            await cursor.execute('INSERT INTO pending_actions (user_phone_number, receiver_phone_number, amount, comment) VALUES (%s, %s, %s, %s)', (user_phone_number, receiver_phone_number, amount, comment))
+
+    @db_timed
+    async def remove_pending_action(self, id, notify=None):
+        # Self-explanatory
+        result = await self.remove_pending_actions([id], notify)
+        return result.get(id)
+
+    @db_timed
+    async def apply_pending_action(self, id, md5, notify=None):
+        # Move one pending action to actions atomically, returns (sender, receiver, amount) or None
+        result = await self.apply_pending_actions([id], md5, notify)
+        return result.get(id)
+
+    @db_timed
+    async def remove_pending_actions(self, ids, notify=None):
+        # Batched remove_pending_action, returns {id: (user_phone_number, amount)} for the ids that existed.
+        # notify(removed) returns [(phone_number, text)] to queue in the outbox in the same transaction
+        async with self._cursor() as cursor:
+            await cursor.execute('DELETE FROM pending_actions WHERE id = ANY(%s) RETURNING id, user_phone_number, amount', (list(ids),))
+            removed = {row[0]: row[1:] for row in await cursor.fetchall()}
+            if notify is not None and removed:
+                await self._enqueue_for_phones(cursor, notify(removed))
+            return removed
+
+    @db_timed
+    async def apply_pending_actions(self, ids, md5, notify=None):
+        # Same statement, locking and outbox writes as DatabaseManager.apply_pending_actions()
+        for attempt in range(APPLY_RETRIES):
+            try:
+                rows = await self._apply_pending_actions(ids, md5, notify)
+                break
+            except (psycopg.errors.DeadlockDetected, psycopg.errors.SerializationFailure):
+                if attempt == APPLY_RETRIES - 1:
+                    raise
+                await asyncio.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+
+        if rows:
+            self._update_head(rows[0][4], md5)
+        # Don't wait for the notification to reach the listener
+        for row in rows:
+            self._balance_cache.invalidate(row[1])
+            self._balance_cache.invalidate(row[2])
+        return {row[0]: row[1:4] for row in rows}
+
+    async def _apply_pending_actions(self, ids, md5, notify):
+        async with self._cursor() as cursor:
+            await cursor.execute(LOCK_TRANSFER_USERS, {'ids': list(ids)})
+            await cursor.execute(APPLY_PENDING_ACTIONS, {'ids': list(ids), 'md5': md5})
+            rows = await cursor.fetchall()
+            if notify is not None and rows:
+                await self._enqueue_for_phones(cursor, notify({row[0]: row[1:4] for row in rows}))
+            return rows
+
+    async def _enqueue_for_phones(self, cursor, messages):
+        # Same as DatabaseManager._enqueue_for_phones()
+        if messages:
+            await cursor.execute(ENQUEUE_FOR_PHONES, {'phones': [phone for phone, text in messages], 'texts': [text for phone, text in messages]})
+
+    @db_timed
+    async def get_last_md5(self):
+        # Served from memory while the listener is connected, see start_listener()
+        if self._listening and self._head is not None:
+            return (self._head[1],) if self._head[1] is not None else None
+        generation = self._head_generation
+
+        async with self._cursor() as cursor:
+            await cursor.execute('SELECT id, md5 FROM actions ORDER BY id DESC LIMIT 1')
+            row = await cursor.fetchone()
+
+        # Don't overwrite news that arrived while querying
+        if self._listening and generation == self._head_generation:
+            self._head = row or (0, None)
+        return (row[1],) if row else None
+
+    @db_timed
+    async def claim_messages(self, limit, lease):
+        # Take up to limit due messages and hide them from other senders for lease seconds.
+        # A sender that dies mid-batch just lets the lease run out and the messages come back
+        async with self._cursor() as cursor:
+            await cursor.execute('''
+                UPDATE outbox SET next_attempt_at = now() + make_interval(secs => %s)
+                WHERE id IN (
+                    SELECT id FROM outbox WHERE next_attempt_at <= now()
+                    ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, chat_id, text, attempts
+            ''', (lease, limit))
+            return sorted(await cursor.fetchall())
+
+    @db_timed
+    async def reschedule_message(self, id, delay, failed):
+        # Put a claimed message back, failed ones count towards the attempt limit
+        async with self._cursor() as cursor:
+            await cursor.execute('UPDATE outbox SET next_attempt_at = now() + make_interval(secs => %s), attempts = attempts + %s WHERE id=%s', (delay, int(failed), id))
+
+    @db_timed
+    async def delete_message(self, id):
+        # Self-explanatory
+        async with self._cursor() as cursor:
+            await cursor.execute('DELETE FROM outbox WHERE id=%s', (id,))
+
+    @db_timed
+    async def count_messages(self):
+        # Outbox depth
+        async with self._cursor() as cursor:
+            await cursor.execute('SELECT COUNT(*) FROM outbox')
+            return (await cursor.fetchone())[0]
+
+    async def _checkpoint(self, cursor, name):
+        # Same as DatabaseManager._checkpoint()
+        await cursor.execute(CLAIM_CHECKPOINT, (name,))
+        await cursor.execute(LOCK_CHECKPOINT, (name,))
+        return await cursor.fetchone()
+
+    async def _save_checkpoint(self, cursor, name, last_id, state=None):
+        await cursor.execute(SAVE_CHECKPOINT, (last_id, state, name))
+
+    @db_timed
+    async def verify_chain(self, batch_size=10000):
+        # Same checks and checkpoints as DatabaseManager.verify_chain()
+        async with self._cursor() as cursor:
+            # Ids above this may still be in flight
+            await cursor.execute('LOCK TABLE actions IN SHARE MODE')
+            await cursor.execute('SELECT COALESCE(MAX(id), 0) FROM actions')
+            high_water = (await cursor.fetchone())[0]
+
+        checked = 0
+        broken_at = None
+        while True:
+            async with self._cursor() as cursor:
+                last_id, prev_md5 = await self._checkpoint(cursor, 'chain')
+                await cursor.execute(CHAIN_BATCH, (last_id, high_water, batch_size))
+                rows = await cursor.fetchall()
+                for id, md5 in rows:
+                    if prev_md5 is not None and md5 != prev_md5 and hashlib.md5(md5.encode()).hexdigest() != prev_md5:
+                        broken_at = id
+                        break
+                    last_id, prev_md5 = id, md5
+                    checked += 1
+                await self._save_checkpoint(cursor, 'chain', last_id, prev_md5)
+
+            if broken_at is not None or len(rows) < batch_size:
+                break
+
+        return {'last_id': last_id, 'checked': checked, 'broken_at': broken_at}
+
+    @db_timed
+    async def get_user_states(self, ttl):
+        # Stored bot user_data younger than ttl seconds, as (user_id, data, updated_at, age in seconds)
+        async with self._cursor() as cursor:
+            await cursor.execute('''
+                SELECT user_id, data, updated_at, EXTRACT(EPOCH FROM now() - updated_at)::FLOAT FROM bot_user_data
+                WHERE updated_at > now() - make_interval(secs => %s)
+            ''', (ttl,))
+            return await cursor.fetchall()
+
+    @db_timed
+    async def get_user_state(self, user_id, ttl):
+        # (data, updated_at) or None
+        async with self._cursor() as cursor:
+            await cursor.execute('SELECT data, updated_at FROM bot_user_data WHERE user_id=%s AND updated_at > now() - make_interval(secs => %s)', (user_id, ttl))
+            return await cursor.fetchone()
+
+    @db_timed
+    async def save_user_states(self, states):
+        # Upsert {user_id: data} in one statement, returns {user_id: updated_at}
+        async with self._cursor() as cursor:
+            await cursor.execute('''
+                INSERT INTO bot_user_data (user_id, data)
+                SELECT * FROM unnest(%s::BIGINT[], %s::JSONB[])
+                ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = now()
+                RETURNING user_id, updated_at
+            ''', (list(states), [Jsonb(data) for data in states.values()]))
+            return dict(await cursor.fetchall())
+
+    @db_timed
+    async def delete_user_state(self, user_id):
+        # Self-explanatory
+        async with self._cursor() as cursor:
+            await cursor.execute('DELETE FROM bot_user_data WHERE user_id=%s', (user_id,))
+
+    @db_timed
+    async def delete_expired_user_states(self, ttl):
+        # Self-explanatory
+        async with self._cursor() as cursor:
+            await cursor.execute('DELETE FROM bot_user_data WHERE updated_at < now() - make_interval(secs => %s)', (ttl,))
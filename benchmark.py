@@ -0,0 +1,207 @@
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import random
+import statistics
+import subprocess
+import time
+import psycopg2
+from datetime import datetime, timezone
+from config import DB_PARAMS
+from async_database import AsyncDatabaseManager
+
+# Micro-benchmarks of AsyncDatabaseManager methods, the manager the API and the bot run on, at several
+# seeded data sizes. Each size gets its own throwaway schema (bench_<size>) in the database given,
+# dropped afterwards unless --keep is passed.
+# Results go to a JSON file, so runs can be compared across commits:
+#
+#   python benchmark.py --database bench --sizes 1000,100000,1000000 --output bench-$(git rev-parse --short HEAD).json
+
+# users, assoc, actions and pending_actions rows all get `size` rows
+SEED = [
+    '''
+    INSERT INTO users (phone_number, balance)
+    SELECT '+7' || (9000000000 + i), 1000000 FROM generate_series(1, %(size)s) i
+    ''',
+    '''
+    INSERT INTO assoc (user_id, phone_number)
+    SELECT i, '+7' || (9000000000 + i) FROM generate_series(1, %(size)s) i
+    ''',
+    '''
+    INSERT INTO actions (user_phone_number, receiver_phone_number, amount, md5)
+    SELECT '+7' || (9000000000 + i), '+7' || (9000000000 + i %% %(size)s + 1), 1, md5(i::text)
+    FROM generate_series(1, %(size)s) i
+    ''',
+    '''
+    INSERT INTO pending_actions (user_phone_number, receiver_phone_number, amount, comment)
+    SELECT '+7' || (9000000000 + i), '+7' || (9000000000 + i %% %(size)s + 1), 1, 'benchmark'
+    FROM generate_series(1, %(size)s) i
+    ''',
+]
+
+
+def phone(i):
+    return f"+7{9000000000 + i}"
+
+
+def cases(db, size, pending_ids):
+    # (method, call) pairs, call returns the awaitable to time. Reads first so the writes don't skew them
+    return [
+        ('get_user', lambda: db.get_user(phone(random.randint(1, size)))),
+        ('get_assoc', lambda: db.get_assoc(random.randint(1, size))),
+        ('get_reverse_assoc', lambda: db.get_reverse_assoc(phone(random.randint(1, size)))),
+        ('get_balance', lambda: db.get_balance(phone(random.randint(1, size)))),
+        ('get_all_pending_actions', db.get_all_pending_actions),
+        ('get_last_md5', db.get_last_md5),
+        ('create_pending_action', lambda: db.create_pending_action(phone(random.randint(1, size)), phone(random.randint(1, size)), 1, 'benchmark')),
+        ('apply_pending_action', lambda: db.apply_pending_action(pending_ids.pop(), 'benchmark')),
+    ]
+
+
+async def measure(call, rounds, min_rounds, max_seconds):
+    # Runs call up to rounds times, stopping early after max_seconds once min_rounds are in
+    samples = []
+    deadline = time.perf_counter() + max_seconds
+    while len(samples) < rounds:
+        start = time.perf_counter()
+        await call()
+        samples.append(time.perf_counter() - start)
+        if len(samples) >= min_rounds and time.perf_counter() > deadline:
+            break
+    samples.sort()
+    return {
+        'rounds': len(samples),
+        'mean': statistics.fmean(samples),
+        'stddev': statistics.pstdev(samples),
+        'min': samples[0],
+        'p50': samples[len(samples) // 2],
+        'p99': samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+        'max': samples[-1],
+    }
+
+
+def prepare_schema(db_params, schema, size, reuse):
+    # Returns True when the schema has to be seeded
+    conn = psycopg2.connect(**db_params)
+    try:
+        with conn, conn.cursor() as cursor:
+            cursor.execute('SELECT 1 FROM information_schema.schemata WHERE schema_name = %s', (schema,))
+            if cursor.fetchone() and reuse:
+                return False
+            cursor.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+            cursor.execute(f'CREATE SCHEMA {schema}')
+            return True
+    finally:
+        conn.close()
+
+
+def seed(db_params, size):
+    conn = psycopg2.connect(**db_params)
+    try:
+        with conn, conn.cursor() as cursor:
+            for statement in SEED:
+                cursor.execute(statement, {'size': size})
+        # ANALYZE can't run inside the transaction above
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute('ANALYZE')
+    finally:
+        conn.close()
+
+
+def drop_schema(db_params, schema):
+    conn = psycopg2.connect(**db_params)
+    try:
+        with conn, conn.cursor() as cursor:
+            cursor.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+    finally:
+        conn.close()
+
+
+async def run_size(args, size, logger):
+    schema = f"bench_{size}"
+    # Everything, AsyncDatabaseManager's own bootstrap included, lands in the benchmark schema
+    db_params = {**DB_PARAMS, "database": args.database, "options": f"-c search_path={schema}"}
+
+    if prepare_schema(db_params, schema, size, args.reuse):
+        # AsyncDatabaseManager creates the tables, the seed fills them
+        db = AsyncDatabaseManager(db_params, pool_min=1, pool_max=1)
+        await db.connect()
+        await db.close()
+        start = time.perf_counter()
+        seed(db_params, size)
+        logger.info("Seeded %s rows per table in %.1f s", size, time.perf_counter() - start)
+
+    # No assoc cache, so get_assoc and get_reverse_assoc time the query at every size, as before the cache.
+    # The listener isn't started, so get_balance and get_last_md5 query too
+    db = AsyncDatabaseManager(db_params, pool_min=args.pool_min, pool_max=args.pool_max, assoc_cache_size=0)
+    await db.connect()
+    try:
+        async with db._cursor() as cursor:
+            await cursor.execute('SELECT id FROM pending_actions ORDER BY id DESC LIMIT %s', (args.rounds,))
+            pending_ids = [row[0] for row in await cursor.fetchall()]
+
+        results = []
+        for method, call in cases(db, size, pending_ids):
+            if args.methods and method not in args.methods:
+                continue
+            rounds = args.rounds
+            if method == 'apply_pending_action':
+                # Every round consumes a seeded pending action
+                rounds = min(rounds, len(pending_ids))
+            result = await measure(call, rounds, args.min_rounds, args.max_seconds)
+            logger.info("%s at %s: mean %.3f ms, p99 %.3f ms over %s rounds", method, size, result['mean'] * 1000, result['p99'] * 1000, result['rounds'])
+            results.append({'size': size, 'method': method, **result})
+        return results
+    finally:
+        await db.close()
+        if not args.keep:
+            drop_schema(db_params, schema)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark AsyncDatabaseManager methods at several data sizes")
+    parser.add_argument("--database", required=True, help="throwaway database to run against")
+    parser.add_argument("--sizes", default="1000,100000,1000000", help="comma separated row counts to seed")
+    parser.add_argument("--methods", type=lambda value: value.split(","), help="comma separated subset of methods")
+    parser.add_argument("--rounds", type=int, default=1000, help="calls per method")
+    parser.add_argument("--min-rounds", type=int, default=5, help="calls per method even past --max-seconds")
+    parser.add_argument("--max-seconds", type=float, default=10.0, help="time budget per method and size")
+    parser.add_argument("--pool-min", type=int, default=1)
+    parser.add_argument("--pool-max", type=int, default=1, help="pool size, calls are timed one at a time so more connections rarely matter")
+    parser.add_argument("--reuse", action="store_true", help="reuse seeded schemas kept by an earlier --keep run")
+    parser.add_argument("--keep", action="store_true", help="keep the seeded schemas")
+    parser.add_argument("--output", default="benchmark.json")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    logger = logging.getLogger("benchmark")
+
+    started_at = datetime.now(timezone.utc).isoformat()
+    results = []
+    for size in (int(value) for value in args.sizes.split(",")):
+        results.extend(asyncio.run(run_size(args, size, logger)))
+
+    report = {
+        'commit': git_commit(),
+        'started_at': started_at,
+        'python': platform.python_version(),
+        'pool_max': args.pool_max,
+        'results': results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info("Wrote %s results to %s", len(results), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,156 @@
 import re
 import math
+import time
 import asyncio
 from decimal import Decimal
-from database import DatabaseManager
+from urllib.parse import urlparse
+from async_database import AsyncDatabaseManager
+from cache import LRUCache
+from metrics import BOT_HANDLER_SECONDS, BOT_UPDATE_QUEUE_DEPTH, timed, watch_database
+from ratelimit import TokenBucket
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, KeyboardButton, InlineKeyboardButton, ReplyKeyboardRemove
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
+    BaseUpdateProcessor,
     CallbackContext,
     CallbackQueryHandler,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     filters,
 )
 
+# Allowed X-Telegram-Bot-Api-Secret-Token values, "change-me" was the old config.py default
+WEBHOOK_SECRET = re.compile(r'[A-Za-z0-9_-]{1,256}')
+
+
+class AdmissionQueue(asyncio.Queue):
+    # Update queue whose get() waits for a free admission slot. Application creates a task for every update
+    # it takes off the queue, so this keeps the backlog in the bounded queue, where the webhook waits on it
+    # and bot_update_queue_depth sees it, instead of in unbounded tasks
+    def __init__(self, maxsize: int, admitted: asyncio.Semaphore):
+        super().__init__(maxsize=maxsize)
+        self._admitted = admitted
+
+    async def get(self):
+        await self._admitted.acquire()
+        try:
+            return await super().get()
+        except BaseException:
+            self._admitted.release()
+            raise
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Processes updates of different users concurrently, but one at a time and in arrival order per user,
+    # which the multi-step send flow in context.user_data relies on
+    def __init__(self, max_concurrent_updates: int, max_admitted_updates: int = None):
+        super().__init__(max_concurrent_updates)
+        # user id -> [lock, number of updates holding or waiting for it]
+        self._locks = {}
+        # Updates taken off the queue and not done yet, running or waiting for their user's lock
+        self._admitted = asyncio.Semaphore(max_admitted_updates or 4 * max_concurrent_updates)
+
+    def update_queue(self, maxsize: int) -> AdmissionQueue:
+        # The application's update queue, has to be used for the admission limit to hold
+        return AdmissionQueue(maxsize, self._admitted)
+
+    @staticmethod
+    def _key(update: object):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def process_update(self, update: object, coroutine) -> None:
+        # BaseUpdateProcessor takes a concurrency slot first, so updates waiting behind a busy user would
+        # hold slots other users could run in. Wait for the user's turn first, then for a slot
+        try:
+            key = self._key(update)
+            if key is None:
+                async with self._semaphore:
+                    await self.do_process_update(update, coroutine)
+                return
+
+            entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+            try:
+                # asyncio.Lock wakes waiters first come, first served
+                async with entry[0]:
+                    async with self._semaphore:
+                        await self.do_process_update(update, coroutine)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+        finally:
+            self._admitted.release()
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
 class TelegramBot:
 
-    def __init__(self, TOKEN: str, db: DatabaseManager):
+    def __init__(self, TOKEN: str, db: AsyncDatabaseManager, update_queue_size=1000, concurrent_updates=32, persistence=None, bot_api_url=None, rate_limit=1.0, rate_burst=5, balance_debounce=3.0):
         self._db = db
-        self.application = Application.builder().token(TOKEN).build()
+
+        # Updates per second and burst allowed per user, see rate_limit()
+        self._limiter = TokenBucket(rate_limit, rate_burst)
+
+        # When each user last got a balance message, presses within balance_debounce seconds of it are answered
+        # with a popup instead. Balances themselves are cached by the database manager
+        self._balance_debounce = balance_debounce
+        self._balance_replies = LRUCache(10000)
+
+        builder = Application.builder()
+        if bot_api_url is not None:
+            # Another Bot API server, e.g. the stub in loadtest.py
+            builder = builder.base_url(f"{bot_api_url}/bot")
+        if persistence is not None:
+            # Keeps the send flow state across restarts, see persistence.PostgresPersistence
+            builder = builder.persistence(persistence)
+        update_processor = PerUserUpdateProcessor(concurrent_updates)
+        self.application = (
+            builder
+            .token(TOKEN)
+            # Bounded, so a flood of webhook requests waits for the handlers instead of piling up in memory
+            .update_queue(update_processor.update_queue(update_queue_size))
+            .concurrent_updates(update_processor)
+            .post_init(self._post_init)
+            .post_shutdown(self._post_shutdown)
+            .build()
+        )
+        self.add_handlers()
+        BOT_UPDATE_QUEUE_DEPTH.set_function(self.application.update_queue.qsize)
+        watch_database(db)
+
+    # Database pool lives on the bot's event loop, the listener keeps its balance cache fresh
+    async def _post_init(self, application: Application) -> None:
+        await self._db.connect()
+        self._db.start_listener()
+
+    async def _post_shutdown(self, application: Application) -> None:
+        await self._db.close()
+
+    # Runs before every other handler, drops updates of users over their rate limit
+    async def rate_limit(self, update: Update, context: CallbackContext) -> None:
+        user = update.effective_user
+        if user is None or self._limiter.allow(user.id):
+            return
+        if update.callback_query:
+            # Stops the button's loading spinner, doesn't count against the message limits
+            await update.callback_query.answer("Слишком много запросов, подождите немного")
+        raise ApplicationHandlerStop
 
     # Operating markup
     op_markup = InlineKeyboardMarkup(
@@ -30,6 +163,7 @@ class TelegramBot:
     )
 
     
+    @timed(BOT_HANDLER_SECONDS, "handler")
     async def actions_command(self, update: Update, context: CallbackContext) -> None:
         await update.message.reply_text(
             "Используйте кнопки ниже для выполнения действий",
@@ -37,9 +171,10 @@ class TelegramBot:
         )
 	
     # Command handler for /start command
+    @timed(BOT_HANDLER_SECONDS, "handler")
     async def start(self, update: Update, context: CallbackContext) -> None:
         # Check if the user is already registered
-        phone = self._db.get_assoc(update.message.chat.id)
+        phone = await self._db.get_assoc(update.message.chat.id)
         markup = ReplyKeyboardMarkup(
             [[KeyboardButton("Отправить номер телефона", request_contact=True)]],
             one_time_keyboard=True,
@@ -54,6 +189,7 @@ class TelegramBot:
 
 
     # Message handler for receiving phone number
+    @timed(BOT_HANDLER_SECONDS, "handler")
     async def phone_auth(self, update: Update, context: CallbackContext) -> None:
         def clean_phone(phone_number):
             match = re.findall(r'\d', phone_number)
@@ -63,7 +199,7 @@ class TelegramBot:
         user_id = update.message.chat.id
         phone_number = clean_phone(update.message.contact.phone_number)
         contact_id = update.message.contact.user_id
-        phone = self._db.get_assoc(update.message.chat.id)
+        phone = await self._db.get_assoc(update.message.chat.id)
 
         if phone:
             await update.message.reply_text(
@@ -77,10 +213,10 @@ class TelegramBot:
             )
         else:
             # Store the user in the database
-            self._db.add_assoc(user_id, phone_number)
+            await self._db.add_assoc(user_id, phone_number)
 
-            if (not self._db.get_user(phone_number)):
-                self._db.add_user(phone_number)
+            if (not await self._db.get_user(phone_number)):
+                await self._db.add_user(phone_number)
 
             await update.message.reply_text(
                 f"Номер {phone_number} был успешно связан с вашей учётной записью",
@@ -92,11 +228,12 @@ class TelegramBot:
             )
 
     # 'balance' and 'send' handler
+    @timed(BOT_HANDLER_SECONDS, "handler")
     async def keyboard_handler(self, update: Update, context: CallbackContext) -> None:
         user_id = update.callback_query.from_user.id
         button_data = update.callback_query.data
         query = update.callback_query
-        phone = self._db.get_assoc(user_id)
+        phone = await self._db.get_assoc(user_id)
         if not phone:
             await update.callback_query.message.reply_text("Вы не авторизованы, попробуйте прописать /start")
             await query.answer()
@@ -109,7 +246,15 @@ class TelegramBot:
 
         # Check if the pressed button has the callback_data 'button_A'
         if button_data == 'balance':
-            await update.callback_query.message.reply_text(f"Ваш баланс: {self._db.get_balance(phone)[0]}", reply_markup=self.op_markup)
+            balance = (await self._db.get_balance(phone[0]))[0]
+            now = time.monotonic()
+            replied = self._balance_replies.get(user_id)
+            if replied is not None and now - replied < self._balance_debounce:
+                # Pressed again right after a reply, no need for another message
+                await query.answer(f"Ваш баланс: {balance}")
+                return
+            self._balance_replies.put(user_id, now)
+            await update.callback_query.message.reply_text(f"Ваш баланс: {balance}", reply_markup=self.op_markup)
         elif button_data == 'send':
             await update.callback_query.message.reply_text("Введите номер телефона контрагента для перевода")
             context.user_data['sending'] = True
@@ -121,6 +266,7 @@ class TelegramBot:
         await query.answer()
 
     # Message handler for sending balance
+    @timed(BOT_HANDLER_SECONDS, "handler")
     async def send_handler(self, update: Update, context: CallbackContext) -> None:
         def clean_phone_number(phone_number):
 
@@ -160,11 +306,10 @@ class TelegramBot:
             return
 
         user_id = context._user_id
-        snd_phone = self._db.get_assoc(user_id)
+        snd_phone = await self._db.get_assoc(user_id)
         recv_phone = context.user_data.get("phone")
         recv_amount = context.user_data.get("amount")
-        phone = self._db.get_assoc(user_id)
-        if not phone:
+        if not snd_phone:
             await update.message.reply_text("Вы не авторизованы, попробуйте прописать /start")
             return
         
@@ -173,7 +318,7 @@ class TelegramBot:
             # Handling phone
             phone = clean_phone_number(update.message.text)
             if phone:
-                user = self._db.get_user(phone)
+                user = await self._db.get_user(phone)
                 
                 if not user:
                     await update.message.reply_text("Пользователь не найден. Введите номер телефона контрагента для перевода")
@@ -196,11 +341,14 @@ class TelegramBot:
             comment = update.message.text
             context.user_data['phone'] = None
             context.user_data['amount'] = None
-            self._db.create_pending_action(amount=recv_amount, user_phone_number=snd_phone[0], receiver_phone_number=recv_phone, comment=comment)
+            await self._db.create_pending_action(amount=recv_amount, user_phone_number=snd_phone[0], receiver_phone_number=recv_phone, comment=comment)
             await update.message.reply_text(f"Запрос на передачу баланса в размере {recv_amount} BCR, пользователю {recv_phone} отправлен")
 
 
-    def run(self):
+    def add_handlers(self):
+        # Rate limit every update first
+        self.application.add_handler(TypeHandler(Update, self.rate_limit), group=-1)
+
         # Add command handlers
         self.application.add_handler(CommandHandler("start", self.start))
 		
@@ -216,5 +364,27 @@ class TelegramBot:
         # Add message handler for sending
         self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.send_handler))
 
-        # Start the bot
-        self.application.run_polling(allowed_updates=Update.ALL_TYPES)
+    async def feed_update(self, data: dict) -> None:
+        # Process a raw update as Telegram would deliver it, for local testing of either mode.
+        # The application has to be initialized
+        await self.application.process_update(Update.de_json(data, self.application.bot))
+
+    def run(self, webhook_url=None, webhook_secret=None, listen="0.0.0.0", port=8443):
+        if webhook_url is None:
+            # Start the bot
+            self.application.run_polling(allowed_updates=Update.ALL_TYPES)
+            return
+
+        # Telegram pushes updates to webhook_url, which has to reach listen:port (usually through a reverse proxy).
+        # Requests without the X-Telegram-Bot-Api-Secret-Token header matching webhook_secret are rejected.
+        # Without a secret anyone reaching the port could post updates in any user's name
+        if not webhook_secret or webhook_secret == "change-me" or not WEBHOOK_SECRET.fullmatch(webhook_secret):
+            raise ValueError("webhook mode needs a webhook secret of 1-256 characters out of A-Z, a-z, 0-9, _ and -")
+        self.application.run_webhook(
+            listen=listen,
+            port=port,
+            url_path=urlparse(webhook_url).path.lstrip("/"),
+            webhook_url=webhook_url,
+            secret_token=webhook_secret,
+            allowed_updates=Update.ALL_TYPES,
+        )
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache:
+    # Bounded least-recently-used map with hit/miss counters, safe to share between threads
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def setdefault(self, key, value):
+        # Store value unless key is already cached, returns the cached value
+        with self._lock:
+            if key in self._data:
+                return self._data[key]
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return value
+
+    def replace(self, key, old, new):
+        # Store new only if key still maps to old (compared by identity), so a value loaded while the key was
+        # invalidated is dropped. new=None removes the key. Returns whether it did
+        with self._lock:
+            if self._data.get(key) is not old:
+                return False
+            if new is None:
+                del self._data[key]
+            else:
+                self._data[key] = new
+            return True
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
@@ -1,2 +1,52 @@
-TOKEN_TG_BOT = 'TOKEN'
-passworddb = "password"
\ No newline at end of file
+TOKEN_TG_BOT = 'TOKEN'
+passworddb = "password"
+
+# Connection settings shared by every process, each process opens its own connections from them
+DB_PARAMS = {
+    "host": "127.0.0.1",
+    "port": "5432",
+    "database": "postgres",
+    "user": "postgres",
+    "password": passworddb,
+}
+
+# Per-process connection pools. The API serves every request from one event loop, so API_DB_POOL_MAX
+# is how many of its queries (and approvals of unrelated accounts) run at once
+API_DB_POOL_MIN = 1
+API_DB_POOL_MAX = 12
+BOT_DB_POOL_MIN = 1
+BOT_DB_POOL_MAX = 10
+
+# Bot updates: long polling when BOT_WEBHOOK_URL is None, otherwise Telegram posts them to this public URL,
+# which has to be forwarded to BOT_WEBHOOK_LISTEN:BOT_WEBHOOK_PORT. Webhook mode needs BOT_WEBHOOK_SECRET,
+# 1-256 random characters out of A-Z, a-z, 0-9, _ and -, e.g. python -c "import secrets; print(secrets.token_urlsafe(32))"
+BOT_WEBHOOK_URL = None
+BOT_WEBHOOK_SECRET = None
+BOT_WEBHOOK_LISTEN = "127.0.0.1"
+BOT_WEBHOOK_PORT = 8443
+BOT_UPDATE_QUEUE_SIZE = 1000
+
+# Updates handled at once across different users, each user's updates are still handled one by one
+BOT_CONCURRENT_UPDATES = 32
+
+# Per-user limit on bot updates: BOT_RATE_LIMIT per second on average, bursts of up to BOT_RATE_BURST.
+# Balance presses within BOT_BALANCE_DEBOUNCE seconds of the last balance message get a popup, not a message
+BOT_RATE_LIMIT = 1.0
+BOT_RATE_BURST = 5
+BOT_BALANCE_DEBOUNCE = 3.0
+
+# Send flow state persistence: flows idle for longer than BOT_STATE_TTL seconds start over, state is written
+# every BOT_STATE_FLUSH_INTERVAL seconds. Set BOT_STATE_SHARED when several bot workers serve the same users
+BOT_STATE_TTL = 3600
+BOT_STATE_FLUSH_INTERVAL = 5
+BOT_STATE_SHARED = False
+
+# Prometheus /metrics port of the bot process (the API serves its own on the API port), None to disable
+BOT_METRICS_PORT = 9101
+
+# Opt-in API database profiling, see profiler.QueryProfiler and GET /debug/db. Statements slower than
+# DB_PROFILE_SLOW_MS are logged to DB_PROFILE_LOG, slow SELECTs with a sampled EXPLAIN ANALYZE
+DB_PROFILE = False
+DB_PROFILE_SLOW_MS = 100
+DB_PROFILE_EXPLAIN_RATE = 0.2
+DB_PROFILE_LOG = "db_profile.log"
@@ -1,141 +1,476 @@
+import hashlib
+import logging
+import random
+import time
 import psycopg2
-from threading import Lock
+import psycopg2.errors
+from contextlib import contextmanager
+from cache import LRUCache
+from metrics import DB_QUERY_SECONDS, DB_WAIT_SECONDS, current_method, timed
+from psycopg2.pool import ThreadedConnectionPool
+from queries import (
+    APPLY_PENDING_ACTIONS, APPLY_RETRIES, CHAIN_BATCH, CLAIM_CHECKPOINT, ENQUEUE_FOR_PHONES, LOCK_CHECKPOINT, LOCK_TRANSFER_USERS, PENDING_WITH_BALANCE,
+    RECONCILE_ALL_USERS, RECONCILE_NEW_ACTIONS, RECONCILE_PHONES, SAVE_CHECKPOINT,
+)
+from schema import BOOTSTRAP_LOCK, MIGRATIONS, TABLES
+from threading import BoundedSemaphore, Lock
+
+logger = logging.getLogger(__name__)
+
+# Per-method latency, see metrics.py
+db_timed = timed(DB_QUERY_SECONDS, "method", method=True)
+
+
+class _CopyRows:
+    # Read-only file over (phone_number, user_id, balance) rows in COPY text format, consumed lazily by copy_expert()
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = ''
+        self.count = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self.count += 1
+            self._buffer += '\t'.join('\\N' if value is None else str(value) for value in row) + '\n'
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
 
 class DatabaseManager:
-    def __init__(self, db_params={'host': 'your_host', 'database': 'your_database', 'user': 'your_user', 'password': 'your_password', 'port': 'your_port'}):
-        # Connect to the database
-        self.conn = psycopg2.connect(**db_params)
-        self.cursor = self.conn.cursor()
+    def __init__(self, db_params={'host': 'your_host', 'database': 'your_database', 'user': 'your_user', 'password': 'your_password', 'port': 'your_port'}, pool_min=None, pool_max=None, assoc_cache_size=10000, profiler=None):
+        self.db_params = db_params
+        self.profiler = profiler
         self.lock = Lock()
+        self.conn = None
+        self.pool = None
+
+        # Telegram id <-> phone associations never change once added, so both directions are cached.
+        # Only hits are stored: an unknown user may register from the other process at any time
+        self._assoc_cache = LRUCache(assoc_cache_size)
+        self._reverse_assoc_cache = LRUCache(assoc_cache_size)
+
+        # Pool counters, see pool_stats()
+        self._stats_lock = Lock()
+        self._checkouts = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+
+        connect_params = dict(db_params)
+        if profiler is not None:
+            # Opt-in statement timing, see profiler.QueryProfiler
+            connect_params['cursor_factory'] = profiler.cursor_factory()
+
+        if pool_max:
+            # Pooled mode: every call checks a connection out for its own duration only,
+            # so callers wait on each other only when the whole pool is busy
+            self.pool = ThreadedConnectionPool(pool_min or 1, pool_max, **connect_params)
+            # ThreadedConnectionPool raises instead of blocking when drained, hence the semaphore
+            self._slots = BoundedSemaphore(pool_max)
+        else:
+            # Connect to the database
+            self.conn = psycopg2.connect(**connect_params)
+
+        with self._cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', (BOOTSTRAP_LOCK,))
+            for statement in TABLES:
+                cursor.execute(statement)
 
-        # Create the users table if it does not exist
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                phone_number TEXT NOT NULL,
-                balance BIGINT NOT NULL
-            )
-        ''')
-
-        # Create the telegram-phone table if it does not exist
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS assoc (
-                user_id BIGINT NOT NULL PRIMARY KEY,
-                phone_number TEXT NOT NULL
-            )
-        ''')
-
-        # Create the pending_actions table if it does not exist
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS pending_actions (
-                id SERIAL PRIMARY KEY,
-                user_phone_number TEXT NOT NULL,
-                receiver_phone_number TEXT NOT NULL,
-                amount BIGINT NOT NULL,
-                comment TEXT NOT NULL
-            )
-        ''')
-
-        # Create the actions table if it does not exist
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS actions (
-                id SERIAL PRIMARY KEY,
-                user_phone_number TEXT NOT NULL,
-                receiver_phone_number TEXT NOT NULL,
-                amount BIGINT NOT NULL,
-                md5 TEXT NOT NULL
-            )
-        ''')
-
-        self.conn.commit()
+            # Bring existing deployments up to date
+            cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+            current_version = cursor.fetchone()[0]
+            for version, statements in MIGRATIONS:
+                if version > current_version:
+                    for statement in statements:
+                        cursor.execute(statement)
+                    cursor.execute('INSERT INTO schema_version (version) VALUES (%s)', (version,))
 
+    @contextmanager
+    def _connection(self):
+        # Check a connection out: the pooled one, or the shared one behind the lock
+        start = time.perf_counter()
+        if self.pool is None:
+            with self.lock:
+                acquired = self._record_checkout(start)
+                try:
+                    yield self.conn
+                finally:
+                    self._record_release(acquired)
+            return
+
+        self._slots.acquire()
+        try:
+            conn = self.pool.getconn()
+            acquired = self._record_checkout(start)
+            try:
+                yield conn
+            finally:
+                self._record_release(acquired)
+                # Drop connections that died mid-call instead of handing them out again
+                self.pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def _cursor(self, name=None):
+        # One cursor per call, committed on success and rolled back on error. A name makes it a server-side cursor
+        with self._connection() as conn:
+            try:
+                with conn.cursor(name=name) as cursor:
+                    yield cursor
+                conn.commit()
+            except BaseException:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+
+    def _record_checkout(self, start):
+        # Returns the checkout time, for _record_release()
+        acquired = time.perf_counter()
+        waited = acquired - start
+        DB_WAIT_SECONDS.observe(waited, method=current_method.get())
+        with self._stats_lock:
+            self._checkouts += 1
+            self._wait_time += waited
+            self._max_wait_time = max(self._max_wait_time, waited)
+        return acquired
+
+    def _record_release(self, acquired):
+        if self.profiler is not None:
+            self.profiler.record_hold(time.perf_counter() - acquired)
+
+    def pool_stats(self):
+        # Checkout counters, wait times are in seconds
+        with self._stats_lock:
+            return {
+                'pooled': self.pool is not None,
+                'checkouts': self._checkouts,
+                'wait_time': self._wait_time,
+                'max_wait_time': self._max_wait_time,
+                'avg_wait_time': self._wait_time / self._checkouts if self._checkouts else 0.0,
+            }
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.closeall()
+        else:
+            self.conn.close()
+
+    @db_timed
     def add_user(self, phone_number):
         # Self-explanatory
-        with self.lock:
-            self.cursor.execute('INSERT INTO users (phone_number, balance) VALUES (%s, 0)', (phone_number,))
-            self.conn.commit()
+        with self._cursor() as cursor:
+            cursor.execute('INSERT INTO users (phone_number, balance) VALUES (%s, 0) ON CONFLICT (phone_number) DO NOTHING', (phone_number,))
 
+    @db_timed
     def get_user(self, phone_number):
         # Self-explanatory
-        with self.lock:
-            self.cursor.execute('SELECT * FROM users WHERE phone_number=%s', (phone_number,))
-            return self.cursor.fetchone()
+        with self._cursor() as cursor:
+            cursor.execute('SELECT * FROM users WHERE phone_number=%s', (phone_number,))
+            return cursor.fetchone()
 
+    @db_timed
     def add_assoc(self, user_id, phone_number):
-        with self.lock:
+        with self._cursor() as cursor:
             # Add association between telegram user id and a phone number
-            self.cursor.execute('INSERT INTO assoc (user_id, phone_number) VALUES (%s, %s)', (user_id, phone_number))
-            self.conn.commit()
+            cursor.execute('INSERT INTO assoc (user_id, phone_number) VALUES (%s, %s)', (user_id, phone_number))
+        self._assoc_cache.put(user_id, (phone_number,))
+        self._reverse_assoc_cache.setdefault(phone_number, (user_id,))
 
+    @db_timed
     def get_assoc(self, user_id):
-        with self.lock:
+        row = self._assoc_cache.get(user_id)
+        if row is not None:
+            return row
+        with self._cursor() as cursor:
             # Self-explanatory
-            self.cursor.execute('SELECT phone_number FROM assoc WHERE user_id=%s', (user_id,))
-            return self.cursor.fetchone()
+            cursor.execute('SELECT phone_number FROM assoc WHERE user_id=%s', (user_id,))
+            row = cursor.fetchone()
+        if row is not None:
+            self._assoc_cache.put(user_id, row)
+        return row
 
+    @db_timed
     def get_reverse_assoc(self, phone_number):
-        with self.lock:
+        row = self._reverse_assoc_cache.get(phone_number)
+        if row is not None:
+            return row
+        with self._cursor() as cursor:
             # Self-explanatory
-            self.cursor.execute('SELECT user_id FROM assoc WHERE phone_number=%s', (phone_number,))
-            return self.cursor.fetchone()
+            cursor.execute('SELECT user_id FROM assoc WHERE phone_number=%s', (phone_number,))
+            row = cursor.fetchone()
+        if row is not None:
+            row = self._reverse_assoc_cache.setdefault(phone_number, row)
+        return row
+
+    def assoc_cache_stats(self):
+        return {'assoc': self._assoc_cache.stats(), 'reverse_assoc': self._reverse_assoc_cache.stats()}
 
+    @db_timed
     def get_balance(self, phone_number):
-        with self.lock:
-            self.cursor.execute('SELECT balance FROM users WHERE phone_number=%s', (phone_number,))
-            return self.cursor.fetchone()
+        # Self-explanatory
+        with self._cursor() as cursor:
+            cursor.execute('SELECT balance FROM users WHERE phone_number=%s', (phone_number,))
+            return cursor.fetchone()
 
+    @db_timed
     def get_all_pending_actions(self):
-        with self.lock:
-            self.cursor.execute('SELECT * FROM pending_actions')
-            return self.cursor.fetchall()
+        with self._cursor() as cursor:
+            cursor.execute('SELECT * FROM pending_actions')
+            return cursor.fetchall()
+
+    @db_timed
+    def get_pending_actions_with_balance(self, after_id=0, limit=None):
+        # Pending actions with the sender's balance and whether the transfer would overdraw it, in one round-trip.
+        # Keyset paginated: pass the last seen id as after_id, limit=None returns everything
+        with self._cursor() as cursor:
+            cursor.execute(PENDING_WITH_BALANCE + ' LIMIT %s', (after_id, limit))
+            return cursor.fetchall()
 
+    def iter_pending_actions_with_balance(self, after_id=0, batch_size=1000, limit=None):
+        # Same rows, streamed from a server-side cursor batch_size rows at a time, at most limit of them.
+        # Holds a connection until exhausted or closed
+        with self._cursor(name='pending_actions_stream') as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(PENDING_WITH_BALANCE + ' LIMIT %s', (after_id, limit))
+            for row in cursor:
+                yield row
+
+    @db_timed
     def create_pending_action(self, user_phone_number, receiver_phone_number, amount, comment):
         # Self-explanatory
-        with self.lock:
-            self.cursor.execute('INSERT INTO pending_actions (user_phone_number, receiver_phone_number, amount, comment) VALUES (%s, %s, %s, %s)', (user_phone_number, receiver_phone_number, amount, comment))
-            self.conn.commit()
+        with self._cursor() as cursor:
+            cursor.execute('INSERT INTO pending_actions (user_phone_number, receiver_phone_number, amount, comment) VALUES (%s, %s, %s, %s)', (user_phone_number, receiver_phone_number, amount, comment))
 
-    def remove_pending_action(self, id):
+    @db_timed
+    def remove_pending_action(self, id, notify=None):
         # Self-explanatory
-        with self.lock:
+        result = self.remove_pending_actions([id], notify)
+        return result.get(id)
 
-            self.cursor.execute('SELECT user_phone_number, amount FROM pending_actions WHERE id=%s', (id,))
-            result = self.cursor.fetchone()
-            if result:
-                recv_phone, amount = result
-                self.cursor.execute('DELETE FROM pending_actions WHERE id=%s', (id,))
-                self.conn.commit()
-                return recv_phone, amount
-            return None
+    @db_timed
+    def apply_pending_action(self, id, md5, notify=None):
+        # Move one pending action to actions atomically, returns (sender, receiver, amount) or None
+        result = self.apply_pending_actions([id], md5, notify)
+        return result.get(id)
 
-    def apply_pending_action(self, id, md5):
-        # Retrieve data from pending_actions
-        with self.lock:
-            self.cursor.execute('SELECT user_phone_number, receiver_phone_number, amount FROM pending_actions WHERE id=%s', (id,))
-            pending_action_data = self.cursor.fetchone()
+    @db_timed
+    def remove_pending_actions(self, ids, notify=None):
+        # Batched remove_pending_action, returns {id: (user_phone_number, amount)} for the ids that existed.
+        # notify(removed) returns [(phone_number, text)] to queue in the outbox in the same transaction
+        with self._cursor() as cursor:
+            cursor.execute('DELETE FROM pending_actions WHERE id = ANY(%s) RETURNING id, user_phone_number, amount', (list(ids),))
+            removed = {row[0]: row[1:] for row in cursor.fetchall()}
+            if notify is not None and removed:
+                self._enqueue_for_phones(cursor, notify(removed))
+            return removed
 
-            if pending_action_data:
-                user_phone_number, receiver_phone_number, amount = pending_action_data
+    @db_timed
+    def apply_pending_actions(self, ids, md5, notify=None):
+        # Move pending actions to actions in one statement and one commit, so the ledger and the balances
+        # can't diverge. Only the users involved are row-locked, in a fixed order, so unrelated transfers
+        # run concurrently and overlapping ones wait for each other. Net changes are summed per phone
+        # first, which keeps self-transfers and repeated phones to one update per row.
+        # notify(applied) returns [(phone_number, text)] to queue in the outbox in the same commit, so a
+        # committed transfer always has its messages.
+        # Returns {id: (sender, receiver, amount)} for the ids that existed
+        for attempt in range(APPLY_RETRIES):
+            try:
+                rows = self._apply_pending_actions(ids, md5, notify)
+                break
+            except (psycopg2.errors.DeadlockDetected, psycopg2.errors.SerializationFailure):
+                if attempt == APPLY_RETRIES - 1:
+                    raise
+                time.sleep(random.uniform(0, 0.01 * 2 ** attempt))
 
-                # Update sender's balance (decrease by amount)
-                self.cursor.execute('UPDATE users SET balance = balance - %s WHERE phone_number=%s', (amount, user_phone_number))
+        return {row[0]: row[1:4] for row in rows}
 
-                # Update receiver's balance (increase by amount)
-                self.cursor.execute('UPDATE users SET balance = balance + %s WHERE phone_number=%s', (amount, receiver_phone_number))
+    def _apply_pending_actions(self, ids, md5, notify):
+        with self._cursor() as cursor:
+            # Both statements go in one round-trip
+            cursor.execute(LOCK_TRANSFER_USERS + ';' + APPLY_PENDING_ACTIONS, {'ids': list(ids), 'md5': md5})
+            rows = cursor.fetchall()
+            if notify is not None and rows:
+                self._enqueue_for_phones(cursor, notify({row[0]: row[1:4] for row in rows}))
+            return rows
 
-                # Remove from pending_actions
-                self.cursor.execute('DELETE FROM pending_actions WHERE id=%s', (id,))
-                self.conn.commit()
+    def _enqueue_for_phones(self, cursor, messages):
+        # Queue (phone_number, text) pairs for notifier.Notifier within the caller's transaction
+        if messages:
+            cursor.execute(ENQUEUE_FOR_PHONES, {'phones': [phone for phone, text in messages], 'texts': [text for phone, text in messages]})
 
-                # Add to actions
-                self.cursor.execute('INSERT INTO actions (user_phone_number, receiver_phone_number, amount, md5) VALUES (%s, %s, %s, %s)', (user_phone_number, receiver_phone_number, amount, md5))
-                self.conn.commit()
+    @db_timed
+    def get_last_md5(self):
+        # Self-explanatory
+        with self._cursor() as cursor:
+            cursor.execute('SELECT md5 FROM actions ORDER BY id DESC LIMIT 1')
+            return cursor.fetchone()
 
-                return (user_phone_number, receiver_phone_number, amount)
-            return None
+    @db_timed
+    def claim_messages(self, limit, lease):
+        # Take up to limit due messages and hide them from other senders for lease seconds.
+        # A sender that dies mid-batch just lets the lease run out and the messages come back
+        with self._cursor() as cursor:
+            cursor.execute('''
+                UPDATE outbox SET next_attempt_at = now() + make_interval(secs => %s)
+                WHERE id IN (
+                    SELECT id FROM outbox WHERE next_attempt_at <= now()
+                    ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, chat_id, text, attempts
+            ''', (lease, limit))
+            return sorted(cursor.fetchall())
 
-    def get_last_md5(self):
+    @db_timed
+    def reschedule_message(self, id, delay, failed):
+        # Put a claimed message back, failed ones count towards the attempt limit
+        with self._cursor() as cursor:
+            cursor.execute('UPDATE outbox SET next_attempt_at = now() + make_interval(secs => %s), attempts = attempts + %s WHERE id=%s', (delay, int(failed), id))
+
+    @db_timed
+    def delete_message(self, id):
         # Self-explanatory
-        with self.lock:
-            self.cursor.execute('SELECT md5 FROM actions ORDER BY id DESC LIMIT 1')
-            return self.cursor.fetchone()
+        with self._cursor() as cursor:
+            cursor.execute('DELETE FROM outbox WHERE id=%s', (id,))
+
+    @db_timed
+    def count_messages(self):
+        # Outbox depth
+        with self._cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM outbox')
+            return cursor.fetchone()[0]
+
+    @db_timed
+    def import_users(self, rows):
+        # Bulk add (phone_number, user_id, balance) rows in one transaction: COPY into a staging table, then
+        # set-based upserts. Phones already in users keep their balance, user ids already linked keep their phone,
+        # user_id may be None. Opening balances of new users are added to ledger_totals, so reconciliation
+        # doesn't report them as drift. Phones must be normalised, '+' and digits. A phone listed more than once
+        # in the batch with different balances is skipped altogether rather than imported with either one.
+        # Returns {'rows', 'users', 'assocs', 'conflicts'}: rows read, users and associations actually added,
+        # and the skipped phones
+        source = _CopyRows(rows)
+        with self._cursor() as cursor:
+            cursor.execute('CREATE TEMP TABLE import_users (phone_number TEXT NOT NULL, user_id BIGINT, balance BIGINT NOT NULL) ON COMMIT DROP')
+            cursor.copy_expert('COPY import_users FROM STDIN', source)
+            cursor.execute('''
+                DELETE FROM import_users WHERE phone_number IN (
+                    SELECT phone_number FROM import_users GROUP BY phone_number HAVING COUNT(DISTINCT balance) > 1
+                )
+                RETURNING phone_number
+            ''')
+            conflicts = sorted({row[0] for row in cursor.fetchall()})
+            cursor.execute('''
+                WITH added AS (
+                    INSERT INTO users (phone_number, balance)
+                    SELECT DISTINCT ON (phone_number) phone_number, balance FROM import_users ORDER BY phone_number
+                    ON CONFLICT (phone_number) DO NOTHING
+                    RETURNING phone_number, balance
+                ), seeded AS (
+                    INSERT INTO ledger_totals (phone_number, total)
+                    SELECT phone_number, balance FROM added WHERE balance <> 0
+                    ON CONFLICT (phone_number) DO UPDATE SET total = ledger_totals.total + EXCLUDED.total
+                )
+                SELECT COUNT(*) FROM added
+            ''')
+            users = cursor.fetchone()[0]
+            cursor.execute('''
+                INSERT INTO assoc (user_id, phone_number)
+                SELECT DISTINCT ON (user_id) user_id, phone_number FROM import_users WHERE user_id IS NOT NULL ORDER BY user_id
+                ON CONFLICT (user_id) DO NOTHING
+            ''')
+            assocs = cursor.rowcount
+        return {'rows': source.count, 'users': users, 'assocs': assocs, 'conflicts': conflicts}
+
+    def _checkpoint(self, cursor, name):
+        # Row-locked (last_id, state) of a maintenance checkpoint, so concurrent runs take turns
+        cursor.execute(CLAIM_CHECKPOINT, (name,))
+        cursor.execute(LOCK_CHECKPOINT, (name,))
+        return cursor.fetchone()
+
+    def _save_checkpoint(self, cursor, name, last_id, state=None):
+        cursor.execute(SAVE_CHECKPOINT, (last_id, state, name))
+
+    def _lock_actions_snapshot(self, cursor):
+        # Wait for transfers in flight, then snapshot: every actions id up to MAX(id) is committed and visible.
+        # Must run first in the transaction
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        cursor.execute('LOCK TABLE actions IN SHARE MODE')
+
+    @db_timed
+    def reconcile_balances(self, full=False, batch_size=100000):
+        # Fold actions added since the last run into ledger_totals and compare the touched users' balances.
+        # Approvals wait while a transaction holds the actions lock, so at most batch_size actions are folded
+        # per transaction and the checkpoint advances after each; a first run over a long ledger no longer
+        # stalls them for the whole scan. full=True also compares every user against the totals, still without
+        # rescanning actions, but under the lock for the whole users scan, so run it off-hours.
+        # Returns {'last_id', 'new_actions', 'drift': [(phone_number, balance, expected)]}
+        new_actions = 0
+        # Balances include actions of later batches, so disagreements before the last batch are only suspects
+        suspects = set()
+        while True:
+            with self._cursor() as cursor:
+                self._lock_actions_snapshot(cursor)
+                last_id = self._checkpoint(cursor, 'balances')[0]
+
+                cursor.execute('SELECT COUNT(*), MAX(id) FROM (SELECT id FROM actions WHERE id > %s ORDER BY id LIMIT %s) batch', (last_id, batch_size))
+                count, max_id = cursor.fetchone()
+
+                drift = []
+                if count:
+                    cursor.execute(RECONCILE_NEW_ACTIONS, {'last_id': last_id, 'until_id': max_id})
+                    drift = cursor.fetchall()
+                    last_id = max_id
+                    new_actions += count
+                    self._save_checkpoint(cursor, 'balances', last_id)
+
+                if count < batch_size:
+                    # Caught up: totals and balances agree on every action in this snapshot
+                    suspects.difference_update(row[0] for row in drift)
+                    if suspects:
+                        cursor.execute(RECONCILE_PHONES, {'phones': list(suspects)})
+                        drift = sorted(drift + cursor.fetchall())
+                    if full:
+                        cursor.execute(RECONCILE_ALL_USERS)
+                        drift = cursor.fetchall()
+                    break
+
+                suspects.update(row[0] for row in drift)
+
+        return {'last_id': last_id, 'new_actions': new_actions, 'drift': drift}
+
+    @db_timed
+    def verify_chain(self, batch_size=10000):
+        # Check the md5 linkage of actions added since the last run: every row's md5 must hash to the previous
+        # row's md5, rows of one batch approval share it. Each batch_size rows are verified in their own
+        # transaction that advances the checkpoint, so an interrupted run keeps its progress and each row is read once.
+        # Returns {'last_id', 'checked', 'broken_at'}, broken_at is the id of the first bad row or None
+        with self._cursor() as cursor:
+            # Ids above this may still be in flight
+            cursor.execute('LOCK TABLE actions IN SHARE MODE')
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM actions')
+            high_water = cursor.fetchone()[0]
+
+        checked = 0
+        broken_at = None
+        while True:
+            with self._cursor() as cursor:
+                last_id, prev_md5 = self._checkpoint(cursor, 'chain')
+                cursor.execute(CHAIN_BATCH, (last_id, high_water, batch_size))
+                rows = cursor.fetchall()
+                for id, md5 in rows:
+                    if prev_md5 is not None and md5 != prev_md5 and hashlib.md5(md5.encode()).hexdigest() != prev_md5:
+                        broken_at = id
+                        break
+                    last_id, prev_md5 = id, md5
+                    checked += 1
+                self._save_checkpoint(cursor, 'chain', last_id, prev_md5)
+
+            if broken_at is not None or len(rows) < batch_size:
+                break
+
+        return {'last_id': last_id, 'checked': checked, 'broken_at': broken_at}
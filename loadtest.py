@@ -0,0 +1,342 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import random
+import threading
+import time
+import httpx
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from api import API
+from async_database import AsyncDatabaseManager
+from bot import TelegramBot
+from config import DB_PARAMS
+
+# Simulates bot users and operators against a local Postgres and a stubbed Telegram Bot API.
+# The API is served by Hypercorn in a child process, like main.py runs it, so the operator numbers
+# measure the server and not the load generator sharing its event loop.
+# Writes to the database it is pointed at, and needs an empty actions table to drive the md5 chain,
+# so only run it against a throwaway database:
+#
+#   python loadtest.py --database loadtest --users 500 --operators 8
+
+TOKEN = "0:loadtest"
+
+
+class StubBotAPI(BaseHTTPRequestHandler):
+    # Answers every Bot API method successfully, sendMessage with a well-formed Message
+    message_id = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        method = urlparse(self.path).path.rsplit("/", 1)[-1]
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode() if length else ""
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(body or "{}")
+        else:
+            params = {key: values[0] for key, values in parse_qs(body).items()}
+        params.update({key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()})
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"}
+        elif method == "sendMessage":
+            with StubBotAPI.lock:
+                StubBotAPI.message_id += 1
+                message_id = StubBotAPI.message_id
+            try:
+                chat_id = int(params.get("chat_id", 0))
+            except ValueError:
+                chat_id = 0
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": str(params.get("text", "")),
+            }
+        else:
+            result = True
+
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+class Recorder:
+    # Latency samples and failures per operation
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, operation, seconds, ok):
+        with self.lock:
+            self.samples.setdefault(operation, []).append(seconds)
+            if not ok:
+                self.errors[operation] = self.errors.get(operation, 0) + 1
+
+    def report(self, elapsed):
+        rows = []
+        for operation, samples in sorted(self.samples.items()):
+            samples = sorted(samples)
+            rows.append({
+                'operation': operation,
+                'count': len(samples),
+                'per_second': len(samples) / elapsed,
+                'p50_ms': samples[len(samples) // 2] * 1000,
+                'p99_ms': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+                'error_rate': self.errors.get(operation, 0) / len(samples),
+            })
+        return rows
+
+
+class Chain:
+    # Pre-computed md5 chain: every approval stores the preimage of the current head
+    def __init__(self, length):
+        keys = [hashlib.md5(str(random.random()).encode()).hexdigest()]
+        for _ in range(length):
+            keys.append(hashlib.md5(keys[-1].encode()).hexdigest())
+        self.keys = keys
+        self.lock = asyncio.Lock()
+
+    def current(self):
+        # Authenticates against the current head without consuming it
+        return self.keys[-1]
+
+    def consume(self):
+        if len(self.keys) < 2:
+            raise RuntimeError("md5 chain exhausted, raise --chain-length")
+        return self.keys.pop()
+
+
+def user_update(update_id, user_id, **fields):
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    message = {"message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "from": user}
+    if "callback_data" in fields:
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": user,
+                "chat_instance": str(user_id),
+                "data": fields["callback_data"],
+                "message": message,
+            },
+        }
+    message.update(fields)
+    return {"update_id": update_id, "message": message}
+
+
+async def simulate_users(tb, recorder, users, transfers, base_id):
+    update_ids = iter(range(1, 10 ** 9))
+
+    async def timed(operation, data):
+        start = time.perf_counter()
+        ok = True
+        try:
+            await tb.feed_update(data)
+        except Exception:
+            logging.exception("%s failed", operation)
+            ok = False
+        recorder.record(operation, time.perf_counter() - start, ok)
+
+    async def one_user(index):
+        user_id = base_id + index
+        phone = f"+7{user_id}"
+        contact = {"phone_number": phone, "first_name": "user", "user_id": user_id}
+        await timed("bot.phone_auth", user_update(next(update_ids), user_id, contact=contact))
+        await timed("bot.balance", user_update(next(update_ids), user_id, callback_data="balance"))
+
+    async def transfer(index):
+        user_id = base_id + index
+        receiver = f"+7{base_id + (index + 1) % users}"
+        for _ in range(transfers):
+            await timed("bot.send", user_update(next(update_ids), user_id, callback_data="send"))
+            await timed("bot.send_phone", user_update(next(update_ids), user_id, text=receiver))
+            await timed("bot.send_amount", user_update(next(update_ids), user_id, text=str(random.randint(1, 100))))
+            await timed("bot.send_comment", user_update(next(update_ids), user_id, text="load test"))
+
+    # Everyone registers first, so every transfer has an existing receiver
+    await asyncio.gather(*(one_user(index) for index in range(users)))
+    await asyncio.gather(*(transfer(index) for index in range(users)))
+
+
+async def operator(client, chain, recorder, stop, batch_size, remove_ratio, backoff=0.5):
+    async def timed(operation, call):
+        # Returns the response, or None when the request itself failed
+        start = time.perf_counter()
+        try:
+            response = await call(chain.current())
+            if response.status_code == 401:
+                # An approval moved the chain on between reading the head and the request landing
+                response = await call(chain.current())
+        except httpx.HTTPError as e:
+            logging.warning("%s failed: %r", operation, e)
+            recorder.record(operation, time.perf_counter() - start, False)
+            return None
+        recorder.record(operation, time.perf_counter() - start, response.status_code == 200)
+        return response
+
+    async def last_key():
+        # The md5 the API recorded last, None when that can't be told
+        try:
+            response = await client.get("/lastkey")
+        except httpx.HTTPError:
+            return None
+        return response.text if response.status_code == 200 else None
+
+    while not stop.is_set():
+        response = await timed("api.pending", lambda md5: client.get("/pending", params={'md5': md5, 'limit': batch_size * 4}))
+        if response is None or response.status_code != 200:
+            # Don't hammer a failing API, or an API whose chain head this one no longer matches
+            await asyncio.sleep(backoff)
+            continue
+        ids = [action['id'] for action in response.json()]
+        if not ids:
+            await asyncio.sleep(0.05)
+            continue
+        # Operators pick overlapping slices, so a remove can hit ids another operator approves and the
+        # other way round. Approvals themselves take turns on chain.lock below
+        ids = random.sample(ids, min(batch_size, len(ids)))
+
+        if random.random() < remove_ratio:
+            response = await timed("api.remove", lambda md5: client.post("/remove", json={'md5': md5, 'ids': ids}))
+            if response is None or response.status_code != 200:
+                await asyncio.sleep(backoff)
+            continue
+
+        # The chain only moves forward one approval at a time. An exhausted chain ends this operator
+        async with chain.lock:
+            md5 = chain.consume()
+            response = await timed("api.approve", lambda _: client.post("/approve", json={'md5': md5, 'ids': ids}))
+            if response is None or response.status_code != 200:
+                # The approval may have committed before failing, only its md5 as the head tells
+                if await last_key() != md5:
+                    chain.keys.append(md5)
+                await asyncio.sleep(backoff)
+            elif not any(result['status'] == 'approved' for result in response.json().get('results', [])):
+                # Nothing was recorded under this md5, so the head didn't move
+                chain.keys.append(md5)
+
+
+def serve_api(db_params, pool_size, stub_url, port):
+    # Runs in the child process, stops on SIGTERM
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.WARNING)
+    api = API(TOKEN, AsyncDatabaseManager(db_params, pool_min=1, pool_max=pool_size), bot_api_url=stub_url)
+    api.run("127.0.0.1", port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the bot handlers and the operator API")
+    parser.add_argument("--database", required=True, help="throwaway database to run against")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--transfers", type=int, default=3, help="transfers started by each user")
+    parser.add_argument("--operators", type=int, default=4, help="concurrent operators")
+    parser.add_argument("--batch-size", type=int, default=10, help="ids per approve/remove call")
+    parser.add_argument("--remove-ratio", type=float, default=0.2)
+    parser.add_argument("--chain-length", type=int, default=100000)
+    parser.add_argument("--pool-size", type=int, default=10)
+    parser.add_argument("--rate-limit", type=float, default=1000.0, help="bot updates per second allowed per user, the default effectively disables it")
+    parser.add_argument("--api-port", type=int, default=5055, help="local port the API is served on")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.WARNING)
+
+    stub = ThreadingHTTPServer(("127.0.0.1", 0), StubBotAPI)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    stub_url = f"http://127.0.0.1:{stub.server_port}"
+
+    db_params = {**DB_PARAMS, "database": args.database}
+    try:
+        elapsed, recorder = asyncio.run(run(args, parser, db_params, stub_url))
+    finally:
+        stub.shutdown()
+
+    rows = recorder.report(elapsed)
+    if args.json:
+        print(json.dumps({'elapsed_seconds': elapsed, 'operations': rows}, indent=2))
+        return
+
+    print(f"{'operation':<18}{'count':>8}{'ops/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>9}")
+    for row in rows:
+        print(f"{row['operation']:<18}{row['count']:>8}{row['per_second']:>10.1f}{row['p50_ms']:>10.2f}{row['p99_ms']:>10.2f}{row['error_rate']:>9.2%}")
+    print(f"elapsed {elapsed:.1f}s")
+
+
+async def run(args, parser, db_params, stub_url):
+    # Synthetic users send their whole flow in one burst
+    tb = TelegramBot(
+        TOKEN,
+        AsyncDatabaseManager(db_params, pool_min=1, pool_max=args.pool_size),
+        bot_api_url=stub_url,
+        rate_limit=args.rate_limit,
+        rate_burst=2 + 4 * args.transfers,
+    )
+    await tb._db.connect()
+    if await tb._db.get_last_md5() is not None:
+        await tb._db.close()
+        parser.error(f"database {args.database} already has actions, the md5 chain can't be continued")
+
+    server = multiprocessing.get_context("spawn").Process(target=serve_api, args=(db_params, args.pool_size, stub_url, args.api_port), daemon=True)
+    server.start()
+
+    recorder = Recorder()
+    chain = Chain(args.chain_length)
+    stop = asyncio.Event()
+
+    # What post_init does when the bot runs for real
+    tb._db.start_listener()
+    await tb.application.initialize()
+    start = time.perf_counter()
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.api_port}", timeout=30) as client:
+        # The server binds in the background, wait until it answers
+        while True:
+            try:
+                await client.get("/lastkey")
+                break
+            except httpx.TransportError:
+                if not server.is_alive():
+                    raise RuntimeError("API server exited on startup")
+                await asyncio.sleep(0.05)
+
+        operators = [
+            asyncio.create_task(operator(client, chain, recorder, stop, args.batch_size, args.remove_ratio))
+            for _ in range(args.operators)
+        ]
+        try:
+            await simulate_users(tb, recorder, args.users, args.transfers, base_id=random.randint(10 ** 9, 2 * 10 ** 9))
+
+            # Let the operators drain what the users queued, as long as any of them is still running
+            while await tb._db.get_pending_actions_with_balance(limit=1):
+                if all(task.done() for task in operators):
+                    logging.error("Every operator stopped with actions still pending")
+                    break
+                await asyncio.sleep(0.1)
+        finally:
+            stop.set()
+            for result in await asyncio.gather(*operators, return_exceptions=True):
+                if isinstance(result, Exception):
+                    logging.error("Operator failed: %r", result)
+            elapsed = time.perf_counter() - start
+            await tb.application.shutdown()
+            await tb._db.close()
+            server.terminate()
+            await asyncio.to_thread(server.join)
+
+    return elapsed, recorder
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,82 @@
 import logging
-from multiprocessing import Process
-from database import DatabaseManager
+import multiprocessing
+import metrics
+from async_database import AsyncDatabaseManager
 from bot import TelegramBot
+from persistence import PostgresPersistence
+from profiler import QueryProfiler
 from api import API
-from config import TOKEN_TG_BOT, passworddb
+from config import (
+    TOKEN_TG_BOT,
+    DB_PARAMS,
+    API_DB_POOL_MIN,
+    API_DB_POOL_MAX,
+    BOT_DB_POOL_MIN,
+    BOT_DB_POOL_MAX,
+    BOT_WEBHOOK_URL,
+    BOT_WEBHOOK_SECRET,
+    BOT_WEBHOOK_LISTEN,
+    BOT_WEBHOOK_PORT,
+    BOT_UPDATE_QUEUE_SIZE,
+    BOT_CONCURRENT_UPDATES,
+    BOT_RATE_LIMIT,
+    BOT_RATE_BURST,
+    BOT_BALANCE_DEBOUNCE,
+    BOT_STATE_TTL,
+    BOT_STATE_FLUSH_INTERVAL,
+    BOT_STATE_SHARED,
+    BOT_METRICS_PORT,
+    DB_PROFILE,
+    DB_PROFILE_SLOW_MS,
+    DB_PROFILE_EXPLAIN_RATE,
+    DB_PROFILE_LOG,
+)
 
 # Telegram API token
 TOKEN = TOKEN_TG_BOT
 
-if __name__ == "__main__":
-    # Set up logging
+
+def setup_logging():
     logging.basicConfig(
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
         level=logging.INFO,
     )
 
-    # Set up database
-    db_manager = DatabaseManager(
-        {
-            "host": "127.0.0.1",
-            "port": "5432",
-            "database": "postgres",
-            "user": "postgres",
-            "password": passworddb,
-        }
+
+def run_bot():
+    # Runs in the child process, everything database-related is created here and never inherited
+    setup_logging()
+    if BOT_METRICS_PORT is not None:
+        metrics.serve(BOT_METRICS_PORT)
+    db = AsyncDatabaseManager(DB_PARAMS, pool_min=BOT_DB_POOL_MIN, pool_max=BOT_DB_POOL_MAX)
+    tb = TelegramBot(
+        TOKEN,
+        db,
+        update_queue_size=BOT_UPDATE_QUEUE_SIZE,
+        concurrent_updates=BOT_CONCURRENT_UPDATES,
+        rate_limit=BOT_RATE_LIMIT,
+        rate_burst=BOT_RATE_BURST,
+        balance_debounce=BOT_BALANCE_DEBOUNCE,
+        persistence=PostgresPersistence(db, ttl=BOT_STATE_TTL, update_interval=BOT_STATE_FLUSH_INTERVAL, shared=BOT_STATE_SHARED),
     )
+    tb.run(webhook_url=BOT_WEBHOOK_URL, webhook_secret=BOT_WEBHOOK_SECRET, listen=BOT_WEBHOOK_LISTEN, port=BOT_WEBHOOK_PORT)
+
+
+if __name__ == "__main__":
+    # Set up logging
+    setup_logging()
+
+    # Set up database for the API process, it connects once the API's event loop runs
+    profiler = None
+    if DB_PROFILE:
+        profiler = QueryProfiler(slow_threshold=DB_PROFILE_SLOW_MS / 1000, explain_sample_rate=DB_PROFILE_EXPLAIN_RATE, log_path=DB_PROFILE_LOG)
+    db_manager = AsyncDatabaseManager(DB_PARAMS, pool_min=API_DB_POOL_MIN, pool_max=API_DB_POOL_MAX, profiler=profiler)
 
-    # Run bot
-    tb = TelegramBot(TOKEN, db_manager)
-    tb_th = Process(target=tb.run)
+    # Run bot in a fresh interpreter so no libpq socket is shared with this process
+    tb_th = multiprocessing.get_context("spawn").Process(target=run_bot)
     tb_th.start()
 
-    # Run API
+    # Run API, the database is closed when it stops
     api = API(TOKEN, db_manager)
     api.run()
 
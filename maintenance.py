@@ -0,0 +1,189 @@
+import argparse
+import csv
+import itertools
+import json
+import logging
+import re
+import sys
+import time
+from decimal import Decimal, InvalidOperation
+from database import DatabaseManager
+from config import DB_PARAMS
+
+logger = logging.getLogger("maintenance")
+
+
+def reconcile(db: DatabaseManager, full: bool) -> bool:
+    start = time.perf_counter()
+    result = db.reconcile_balances(full=full)
+    elapsed = (time.perf_counter() - start) * 1000
+
+    logger.info(
+        "Reconciled %s new actions up to id %s in %.1f ms",
+        result['new_actions'], result['last_id'], elapsed,
+    )
+    for phone_number, balance, expected in result['drift']:
+        logger.error("Balance drift for %s: balance %s, ledger %s", phone_number, balance, expected)
+    return not result['drift']
+
+
+def verify_chain(db: DatabaseManager) -> bool:
+    start = time.perf_counter()
+    result = db.verify_chain()
+    elapsed = (time.perf_counter() - start) * 1000
+
+    logger.info(
+        "Verified %s new actions up to id %s in %.1f ms",
+        result['checked'], result['last_id'], elapsed,
+    )
+    if result['broken_at'] is not None:
+        logger.error("Hash chain broken at action %s", result['broken_at'])
+    return result['broken_at'] is None
+
+
+def clean_phone(phone_number):
+    # Same normalisation as the bot's phone_auth, '+' and the digits
+    digits = ''.join(re.findall(r'\d', str(phone_number)))
+    return '+' + digits if digits else None
+
+
+def parse_integer(value, field):
+    # Whole numbers only, the same in CSV and JSON: 12, 12.0 and "12" pass, 12.7, "1.5" and true don't
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"{field} is not a number: {value!r}")
+    try:
+        number = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f"{field} is not a number: {value!r}")
+    if not number.is_finite() or number != number.to_integral_value() or abs(number) >= 2 ** 63:
+        raise ValueError(f"{field} is not a whole number: {value!r}")
+    return int(number)
+
+
+def read_import_rows(f, fmt):
+    # Yields (line number, record) from CSV with a header row or from JSON lines. Both use the fields
+    # phone_number, user_id (the Telegram id, optional) and balance (optional, 0 by default)
+    if fmt == "csv":
+        reader = csv.DictReader(f)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_number, line in enumerate(f, 1):
+        if line.strip():
+            try:
+                yield line_number, json.loads(line)
+            except ValueError:
+                yield line_number, None
+
+
+def parse_import_rows(records, invalid):
+    # (phone_number, user_id, balance) for import_users(), bad records are logged and counted in invalid[0]
+    for line_number, record in records:
+        try:
+            if not isinstance(record, dict):
+                raise ValueError("not a JSON object")
+            phone_number = clean_phone(record.get('phone_number') or '')
+            user_id = record.get('user_id')
+            user_id = parse_integer(user_id, 'user_id') if user_id not in (None, '') else None
+            balance = record.get('balance')
+            balance = parse_integer(balance, 'balance') if balance not in (None, '') else 0
+            if phone_number is None:
+                raise ValueError("no phone number")
+        except (TypeError, ValueError) as e:
+            invalid[0] += 1
+            logger.warning("Skipping record %s: %s", line_number, e)
+            continue
+        yield phone_number, user_id, balance
+
+
+def import_users(db: DatabaseManager, path: str, fmt: str, batch_size: int) -> bool:
+    if fmt is None:
+        fmt = "jsonl" if path.endswith((".jsonl", ".ndjson")) else "csv"
+
+    invalid = [0]
+    totals = {'rows': 0, 'users': 0, 'assocs': 0}
+    conflicts = 0
+    start = time.perf_counter()
+    f = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+    try:
+        rows = parse_import_rows(read_import_rows(f, fmt), invalid)
+        # One transaction per batch, rows are streamed from the file into COPY so memory stays flat.
+        # Rerunning an interrupted import is safe, rows already in are skipped
+        while True:
+            result = db.import_users(itertools.islice(rows, batch_size))
+            if not result['rows']:
+                break
+            for key in totals:
+                totals[key] += result[key]
+            for phone_number in result['conflicts']:
+                logger.warning("Skipping %s: listed more than once with different balances", phone_number)
+            conflicts += len(result['conflicts'])
+            elapsed = time.perf_counter() - start
+            logger.info("Imported %s rows, %.0f rows/s", totals['rows'], totals['rows'] / elapsed)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+    elapsed = time.perf_counter() - start
+    logger.info(
+        "Import done: %s rows in %.1f s (%.0f rows/s), %s users and %s associations added, %s invalid records and %s conflicting phones skipped",
+        totals['rows'], elapsed, totals['rows'] / elapsed if elapsed else 0, totals['users'], totals['assocs'], invalid[0], conflicts,
+    )
+    return not invalid[0] and not conflicts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ledger maintenance jobs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    reconcile_parser = subparsers.add_parser(
+        "reconcile",
+        help="check users.balance against the actions ledger, only scanning actions added since the last run",
+    )
+    reconcile_parser.add_argument("--full", action="store_true", help="also compare every user, not just the ones with new actions. Blocks approvals while scanning users, run it off-hours")
+    reconcile_parser.add_argument("--interval", type=float, help="keep running, every INTERVAL seconds")
+
+    verify_parser = subparsers.add_parser(
+        "verify-chain",
+        help="check the md5 chain of the actions ledger, only reading actions added since the last run",
+    )
+    verify_parser.add_argument("--interval", type=float, help="keep running, every INTERVAL seconds")
+
+    import_parser = subparsers.add_parser(
+        "import-users",
+        help="bulk add users, their Telegram ids and opening balances from CSV or JSON lines",
+    )
+    import_parser.add_argument("path", help="input file with phone_number, user_id and balance fields, - for stdin")
+    import_parser.add_argument("--format", choices=["csv", "jsonl"], help="input format, by default guessed from the file extension")
+    import_parser.add_argument("--batch-size", type=int, default=50000, help="rows per transaction")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+
+    if args.command == "reconcile":
+        job = lambda db: reconcile(db, args.full)
+    elif args.command == "verify-chain":
+        job = verify_chain
+    else:
+        job = lambda db: import_users(db, args.path, args.format, args.batch_size)
+
+    db = DatabaseManager(DB_PARAMS)
+    try:
+        if getattr(args, 'interval', None) is None:
+            return 0 if job(db) else 1
+        while True:
+            try:
+                job(db)
+            except Exception:
+                logger.exception("%s failed", args.command)
+            time.sleep(args.interval)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+import bisect
+import functools
+import inspect
+import time
+from contextvars import ContextVar
+from threading import Lock, Thread
+
+# Name of the DatabaseManager method running in this thread or task, so connection waits can be attributed to it
+current_method = ContextVar("current_method", default="")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value)}"' for name, value in pairs) + "}"
+
+
+class Histogram:
+    # Prometheus-style cumulative histogram, one series per label combination
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts (last one is +Inf), sum, count
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Gauge:
+    # Value read at scrape time from a callback, or set directly. With labelnames the value is a
+    # {label values tuple: value} dict, one series per entry
+    def __init__(self, name, documentation, function=None, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.labelnames = tuple(labelnames)
+        self.value = {} if self.labelnames else 0
+        _registry.append(self)
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.function() if self.function is not None else self.value
+        except Exception:
+            # A failing callback must not break the whole scrape
+            return lines
+        if not self.labelnames:
+            lines.append(f"{self.name} {value}")
+            return lines
+        for key, series_value in sorted(value.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {series_value}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+def timed(histogram, label, method=False):
+    # Decorator observing the duration of a function or coroutine function under label=<its name>.
+    # method=True also publishes the name through current_method
+    def decorator(function):
+        name = function.__name__
+
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                token = current_method.set(name) if method else None
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start, **{label: name})
+                    if token is not None:
+                        current_method.reset(token)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                token = current_method.set(name) if method else None
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start, **{label: name})
+                    if token is not None:
+                        current_method.reset(token)
+        return wrapper
+    return decorator
+
+
+def watch_database(db):
+    # Pool and cache counters of this process' DatabaseManager or AsyncDatabaseManager, read at scrape time
+    def caches():
+        return {**db.assoc_cache_stats(), 'balance': db.balance_cache_stats()}
+
+    DB_CACHE_HITS.set_function(lambda: {(name,): stats['hits'] for name, stats in caches().items()})
+    DB_CACHE_MISSES.set_function(lambda: {(name,): stats['misses'] for name, stats in caches().items()})
+    DB_CACHE_ENTRIES.set_function(lambda: {(name,): stats['size'] for name, stats in caches().items()})
+    DB_POOL_CHECKOUTS.set_function(lambda: db.pool_stats()['checkouts'])
+    DB_POOL_WAIT_SECONDS.set_function(lambda: db.pool_stats()['wait_time'])
+    DB_POOL_MAX_WAIT_SECONDS.set_function(lambda: db.pool_stats()['max_wait_time'])
+
+
+def render():
+    # Everything registered in this process, in the Prometheus text exposition format
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def serve(port, host="0.0.0.0"):
+    # Standalone /metrics endpoint for processes without the API app (the bot)
+    from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+    def app(environ, start_response):
+        if environ.get("PATH_INFO") != "/metrics":
+            start_response("404 Not Found", [("Content-Type", "text/plain")])
+            return [b"Not Found"]
+        start_response("200 OK", [("Content-Type", CONTENT_TYPE)])
+        return [render().encode()]
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = make_server(host, port, app, handler_class=QuietHandler)
+    Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+DB_QUERY_SECONDS = Histogram("db_query_seconds", "Duration of database manager calls, including connection waits", ["method"])
+DB_WAIT_SECONDS = Histogram("db_lock_wait_seconds", "Time spent waiting for a pooled connection or the shared connection lock", ["method"])
+BOT_HANDLER_SECONDS = Histogram("bot_handler_seconds", "Duration of Telegram bot handlers", ["handler"])
+API_REQUEST_SECONDS = Histogram("api_request_seconds", "Duration of API requests", ["route", "status"])
+TELEGRAM_SEND_SECONDS = Histogram("telegram_send_seconds", "Duration of Bot API sendMessage calls made by the notifier", ["result"])
+OUTBOX_DEPTH = Gauge("outbox_depth", "Messages waiting in the outbox")
+BOT_UPDATE_QUEUE_DEPTH = Gauge("bot_update_queue_depth", "Updates waiting in the bot's update queue")
+DB_CACHE_HITS = Gauge("db_cache_hits", "Lookups served by a database manager cache since start", labelnames=["cache"])
+DB_CACHE_MISSES = Gauge("db_cache_misses", "Lookups a database manager cache couldn't serve since start", labelnames=["cache"])
+DB_CACHE_ENTRIES = Gauge("db_cache_entries", "Entries held by a database manager cache", labelnames=["cache"])
+DB_POOL_CHECKOUTS = Gauge("db_pool_checkouts", "Connections checked out of the pool since start")
+DB_POOL_WAIT_SECONDS = Gauge("db_pool_wait_seconds", "Total time spent waiting for a pooled connection since start")
+DB_POOL_MAX_WAIT_SECONDS = Gauge("db_pool_max_wait_seconds", "Longest wait for a pooled connection since start")
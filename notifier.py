@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import time
+import httpx
+from async_database import AsyncDatabaseManager
+from metrics import TELEGRAM_SEND_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class Notifier:
+    # Background task draining the outbox table into the Telegram Bot API, runs on the API's event loop
+    def __init__(
+        self,
+        token: str,
+        db: AsyncDatabaseManager,
+        base_url="https://api.telegram.org",
+        global_rate=25,
+        chat_interval=1.0,
+        max_attempts=8,
+        timeout=10,
+        batch_size=50,
+    ):
+        self.db = db
+        self.url = f"{base_url}/bot{token}/sendMessage"
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+
+        # Telegram allows about 30 messages per second overall and about one per second per chat
+        self.global_interval = 1.0 / global_rate
+        self.chat_interval = chat_interval
+        self._last_send = 0.0
+        self._last_chat_send = {}
+
+        self.client = None
+        self._wake = None
+        self._stop = None
+        self._task = None
+
+    def start(self):
+        # Needs the running loop. Keep-alive connection to the Bot API, reused by every send
+        self.client = httpx.AsyncClient(timeout=self.timeout, limits=httpx.Limits(max_connections=1, max_keepalive_connections=1))
+        self._wake = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._stop.set()
+            self._wake.set()
+            await self._task
+            self._task = None
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def wake(self):
+        # New messages were queued, don't wait for the next poll
+        if self._wake is not None:
+            self._wake.set()
+
+    async def _run(self):
+        while not self._stop.is_set():
+            try:
+                messages = await self.db.claim_messages(self.batch_size, lease=self.timeout * self.batch_size)
+            except Exception:
+                logger.exception("Failed to read the outbox")
+                messages = []
+
+            if not messages:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+                continue
+
+            for id, chat_id, text, attempts in messages:
+                if self._stop.is_set():
+                    # Unsent messages come back once their lease runs out
+                    break
+                try:
+                    await self._deliver(id, chat_id, text, attempts)
+                except Exception:
+                    logger.exception("Failed to update outbox message %s", id)
+
+    async def _deliver(self, id, chat_id, text, attempts):
+        now = time.monotonic()
+
+        # Per-chat limit: push the message back instead of stalling every other chat
+        wait = self._last_chat_send.get(chat_id, 0.0) + self.chat_interval - now
+        if wait > 0:
+            await self.db.reschedule_message(id, wait, failed=False)
+            return
+
+        # Global limit
+        wait = self._last_send + self.global_interval - now
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        self._last_send = self._last_chat_send[chat_id] = time.monotonic()
+        self._forget_idle_chats()
+
+        ok, retry_after = await self._send(chat_id, text, attempts)
+        if ok:
+            await self.db.delete_message(id)
+        elif retry_after is None or attempts + 1 >= self.max_attempts:
+            logger.error("Dropping message %s to chat %s after %s attempts", id, chat_id, attempts + 1)
+            await self.db.delete_message(id)
+        else:
+            await self.db.reschedule_message(id, retry_after, failed=True)
+
+    async def _send(self, chat_id, text, attempts):
+        # Returns (sent, retry delay), a None delay means retrying won't help
+        backoff = min(2 ** attempts, 300)
+        start = time.perf_counter()
+        try:
+            response = await self.client.post(self.url, params={'chat_id': chat_id, 'text': text})
+            result = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            TELEGRAM_SEND_SECONDS.observe(time.perf_counter() - start, result="error")
+            logger.warning("Failed to send message to chat %s: %s", chat_id, e)
+            return False, backoff
+        TELEGRAM_SEND_SECONDS.observe(time.perf_counter() - start, result=str(response.status_code))
+
+        if result.get('ok'):
+            return True, None
+
+        logger.warning("Failed to send message. Telegram API response: %s", result)
+        if response.status_code == 429:
+            return False, result.get('parameters', {}).get('retry_after', backoff)
+        if response.status_code >= 500:
+            return False, backoff
+        # Blocked bot, unknown chat and other client errors are permanent
+        return False, None
+
+    def _forget_idle_chats(self):
+        if len(self._last_chat_send) > 10000:
+            cutoff = time.monotonic() - self.chat_interval
+            self._last_chat_send = {chat_id: t for chat_id, t in self._last_chat_send.items() if t > cutoff}
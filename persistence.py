@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import time
+from async_database import AsyncDatabaseManager
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+
+class PostgresPersistence(BasePersistence):
+    # Keeps context.user_data (the send flow state) in the bot_user_data table, so a restart
+    # doesn't drop users halfway through a transfer. Only user_data is persisted.
+    #
+    # Writes are batched twice: the application hands changed user_data over every update_interval
+    # seconds, and everything handed over in one go is written with a single round-trip.
+    # Flows untouched for ttl seconds are treated as abandoned and start over.
+    # With shared=True the stored state is checked before each update and wins when another bot worker
+    # wrote it more recently. Keep update_interval short then, as workers only see each other's flushed state
+    def __init__(self, db: AsyncDatabaseManager, ttl=3600, update_interval=5, shared=False):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.db = db
+        self.ttl = ttl
+        self.shared = shared
+        # Last activity (monotonic) and the updated_at of the stored version this worker has seen, per user
+        self._touched = {}
+        self._seen = {}
+        self._pending = {}
+        self._write_task = None
+
+    async def get_user_data(self):
+        # Called while the application initializes, before post_init
+        await self.db.connect()
+        await self.db.delete_expired_user_states(self.ttl)
+
+        user_data = {}
+        now = time.monotonic()
+        for user_id, data, updated_at, age in await self.db.get_user_states(self.ttl):
+            user_data[user_id] = data
+            self._seen[user_id] = updated_at
+            self._touched[user_id] = now - age
+        return user_data
+
+    async def update_user_data(self, user_id, data):
+        self._touched[user_id] = time.monotonic()
+        self._pending[user_id] = dict(data)
+        if self._write_task is None:
+            self._write_task = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self):
+        # Let the rest of this round of update_user_data calls queue up first
+        await asyncio.sleep(0)
+        pending, self._pending = self._pending, {}
+        try:
+            if pending:
+                self._seen.update(await self.db.save_user_states(pending))
+        except Exception:
+            logger.exception("Failed to save the state of %s users, retrying with the next write", len(pending))
+            # States handed over since then are newer
+            self._pending = {**pending, **self._pending}
+            return
+        finally:
+            # Only cleared now, so flush() waits for the write in flight
+            self._write_task = None
+        if self._pending:
+            # Handed over while the write was in flight
+            self._write_task = asyncio.create_task(self._write_pending())
+
+    async def refresh_user_data(self, user_id, user_data):
+        # Called before every update of this user
+        if self.shared:
+            row = await self.db.get_user_state(user_id, self.ttl)
+            seen = self._seen.get(user_id)
+            if row is not None and (seen is None or row[1] > seen):
+                user_data.clear()
+                user_data.update(row[0])
+                self._seen[user_id] = row[1]
+                self._touched[user_id] = time.monotonic()
+
+        touched = self._touched.get(user_id)
+        if touched is not None and time.monotonic() - touched > self.ttl:
+            user_data.clear()
+        self._touched[user_id] = time.monotonic()
+
+    async def drop_user_data(self, user_id):
+        self._pending.pop(user_id, None)
+        self._touched.pop(user_id, None)
+        self._seen.pop(user_id, None)
+        await self.db.delete_user_state(user_id)
+
+    async def flush(self):
+        while self._write_task is not None:
+            await self._write_task
+        if self._pending:
+            # Retries a failed write once more
+            self._write_task = asyncio.create_task(self._write_pending())
+            await self._write_task
+
+    # Nothing else is persisted
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
@@ -0,0 +1,212 @@
+import json
+import logging
+import os
+import random
+import sys
+import time
+import psycopg2.extensions
+from logging.handlers import RotatingFileHandler
+from threading import Lock
+from metrics import current_method
+
+# Frames from these files are skipped when looking for the code that called into the database
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_INTERNAL_FILES = {os.path.join(_HERE, name) for name in ("profiler.py", "database.py", "async_database.py", "metrics.py")}
+
+
+def _params_shape(params):
+    # Types only, values never end up in the log
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {key: _params_shape(value) for key, value in params.items()}
+    if isinstance(params, (list, tuple)):
+        if len(params) > 5:
+            return f"{type(params).__name__}[{len(params)}]"
+        return [_params_shape(value) for value in params]
+    return type(params).__name__
+
+
+def _call_site():
+    frame = sys._getframe(2)
+    while frame is not None and os.path.abspath(frame.f_code.co_filename) in _INTERNAL_FILES:
+        frame = frame.f_back
+    if frame is None:
+        return "?"
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno}"
+
+
+class QueryProfiler:
+    # Opt-in DatabaseManager and AsyncDatabaseManager profiling: per call site statement timings and connection hold times,
+    # slow statements logged to a rotating file with a sampled EXPLAIN ANALYZE of slow SELECTs.
+    # Costs a stack walk per statement, so keep it off unless investigating
+    def __init__(self, slow_threshold=0.1, explain_sample_rate=0.2, log_path="db_profile.log", max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.slow_threshold = slow_threshold
+        self.explain_sample_rate = explain_sample_rate
+        self._lock = Lock()
+        self._queries = {}
+        self._holds = {}
+
+        self.logger = logging.getLogger("db_profile")
+        self.logger.propagate = False
+        if log_path and not self.logger.handlers:
+            self.logger.addHandler(RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backup_count))
+        self.logger.setLevel(logging.INFO)
+
+    def cursor_factory(self):
+        # psycopg2 cursor class timing every execute through this profiler
+        profiler = self
+
+        class ProfilingCursor(psycopg2.extensions.cursor):
+            def execute(self, query, vars=None):
+                start = time.perf_counter()
+                try:
+                    result = super().execute(query, vars)
+                except BaseException:
+                    profiler.record_query(self, query, vars, time.perf_counter() - start, failed=True)
+                    raise
+                profiler.record_query(self, query, vars, time.perf_counter() - start)
+                return result
+
+        return ProfilingCursor
+
+    def async_cursor_factory(self):
+        # The same for psycopg 3 async connections, see AsyncDatabaseManager
+        import psycopg
+        profiler = self
+
+        class AsyncProfilingCursor(psycopg.AsyncCursor):
+            async def execute(self, query, params=None, **kwargs):
+                start = time.perf_counter()
+                try:
+                    result = await super().execute(query, params, **kwargs)
+                except BaseException:
+                    profiler._record(query, params, time.perf_counter() - start, failed=True)
+                    raise
+                duration = time.perf_counter() - start
+                entry = profiler._record(query, params, duration)
+                if entry is not None:
+                    if profiler._should_explain(self, entry['sql']):
+                        entry['plan'] = await profiler._explain_async(self, query, params)
+                    profiler.logger.info(json.dumps(entry, ensure_ascii=False))
+                return result
+
+        return AsyncProfilingCursor
+
+    def record_query(self, cursor, query, params, duration, failed=False):
+        entry = self._record(query, params, duration, failed)
+        if entry is None:
+            return
+        if not failed and self._should_explain(cursor, entry['sql']):
+            entry['plan'] = self._explain(cursor, query, params)
+        self.logger.info(json.dumps(entry, ensure_ascii=False))
+
+    def _record(self, query, params, duration, failed=False):
+        # Aggregates the statement, returns the log entry when it was slow. Logged right away when it failed
+        sql = " ".join(query.split()) if isinstance(query, str) else str(query)
+        key = (current_method.get(), _call_site(), sql)
+        with self._lock:
+            stats = self._queries.get(key)
+            if stats is None:
+                stats = self._queries[key] = {'count': 0, 'total': 0.0, 'max': 0.0, 'params': _params_shape(params)}
+            stats['count'] += 1
+            stats['total'] += duration
+            stats['max'] = max(stats['max'], duration)
+
+        if duration < self.slow_threshold:
+            return None
+
+        entry = {
+            'method': key[0],
+            'call_site': key[1],
+            'sql': sql,
+            'params': _params_shape(params),
+            'seconds': round(duration, 6),
+        }
+        if failed:
+            entry['failed'] = True
+            self.logger.info(json.dumps(entry, ensure_ascii=False))
+            return None
+        return entry
+
+    def _should_explain(self, cursor, sql):
+        # EXPLAIN ANALYZE runs the statement again, so only plain reads on client-side cursors qualify
+        if getattr(cursor, 'name', None) or random.random() >= self.explain_sample_rate:
+            return False
+        upper = sql.upper()
+        return upper.startswith("SELECT") and "FOR UPDATE" not in upper and "PG_NOTIFY" not in upper
+
+    def _explain(self, cursor, query, params):
+        # A separate plain cursor, so the caller's results stay untouched, and a savepoint, so a failing
+        # EXPLAIN doesn't abort the caller's transaction
+        with cursor.connection.cursor(cursor_factory=psycopg2.extensions.cursor) as explain:
+            explain.execute("SAVEPOINT profiler_explain")
+            try:
+                explain.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, params)
+                plan = [row[0] for row in explain.fetchall()]
+            except psycopg2.Error as e:
+                explain.execute("ROLLBACK TO SAVEPOINT profiler_explain")
+                plan = [f"EXPLAIN failed: {e}"]
+            explain.execute("RELEASE SAVEPOINT profiler_explain")
+            return plan
+
+    async def _explain_async(self, cursor, query, params):
+        # _explain() for psycopg 3, through a plain cursor so the EXPLAIN isn't profiled itself
+        import psycopg
+        async with psycopg.AsyncCursor(cursor.connection) as explain:
+            await explain.execute("SAVEPOINT profiler_explain")
+            try:
+                await explain.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, params)
+                plan = [row[0] for row in await explain.fetchall()]
+            except psycopg.Error as e:
+                await explain.execute("ROLLBACK TO SAVEPOINT profiler_explain")
+                plan = [f"EXPLAIN failed: {e}"]
+            await explain.execute("RELEASE SAVEPOINT profiler_explain")
+            return plan
+
+    def record_hold(self, held):
+        # How long a DatabaseManager method kept its connection (or the shared lock)
+        method = current_method.get()
+        with self._lock:
+            stats = self._holds.get(method)
+            if stats is None:
+                stats = self._holds[method] = {'count': 0, 'total': 0.0, 'max': 0.0}
+            stats['count'] += 1
+            stats['total'] += held
+            stats['max'] = max(stats['max'], held)
+
+    def report(self, limit=50):
+        # Statements by total time, and connection hold times per method
+        with self._lock:
+            queries = sorted(self._queries.items(), key=lambda item: item[1]['total'], reverse=True)[:limit]
+            holds = sorted(self._holds.items(), key=lambda item: item[1]['total'], reverse=True)
+            return {
+                'queries': [
+                    {
+                        'method': method,
+                        'call_site': call_site,
+                        'sql': sql,
+                        'params': stats['params'],
+                        'count': stats['count'],
+                        'total_seconds': stats['total'],
+                        'avg_seconds': stats['total'] / stats['count'],
+                        'max_seconds': stats['max'],
+                    }
+                    for (method, call_site, sql), stats in queries
+                ],
+                'connection_hold': [
+                    {
+                        'method': method,
+                        'count': stats['count'],
+                        'total_seconds': stats['total'],
+                        'avg_seconds': stats['total'] / stats['count'],
+                        'max_seconds': stats['max'],
+                    }
+                    for method, stats in holds
+                ],
+            }
+
+    def reset(self):
+        with self._lock:
+            self._queries.clear()
+            self._holds.clear()
@@ -0,0 +1,104 @@
+# SQL shared by DatabaseManager and AsyncDatabaseManager
+
+PENDING_WITH_BALANCE = '''
+    SELECT p.id, p.user_phone_number, p.receiver_phone_number, p.amount, p.comment,
+           u.balance, COALESCE(u.balance, 0) < p.amount AS less_than_zero
+    FROM pending_actions p
+    LEFT JOIN users u ON u.phone_number = p.user_phone_number
+    WHERE p.id > %s
+    ORDER BY p.id
+'''
+
+# Attempts for a transfer that lost a deadlock or serialization race
+APPLY_RETRIES = 5
+
+# Row-locks the users touched by the given pending actions in phone number order, so that concurrent
+# transfers over overlapping accounts queue up instead of deadlocking
+LOCK_TRANSFER_USERS = '''
+    SELECT 1 FROM users
+    WHERE phone_number IN (
+        SELECT user_phone_number FROM pending_actions WHERE id = ANY(%(ids)s)
+        UNION
+        SELECT receiver_phone_number FROM pending_actions WHERE id = ANY(%(ids)s)
+    )
+    ORDER BY phone_number
+    FOR UPDATE
+'''
+
+# Moves pending actions %(ids)s to actions under %(md5)s. Net changes are summed per phone first, since
+# Postgres applies only one of several updates to the same row within a statement.
+# Returns id, sender, receiver, amount and the new chain head id
+APPLY_PENDING_ACTIONS = '''
+    WITH moved AS (
+        DELETE FROM pending_actions WHERE id = ANY(%(ids)s)
+        RETURNING id, user_phone_number, receiver_phone_number, amount
+    ), deltas AS (
+        SELECT phone_number, SUM(delta)::BIGINT AS delta FROM (
+            SELECT user_phone_number AS phone_number, -amount AS delta FROM moved
+            UNION ALL
+            SELECT receiver_phone_number, amount FROM moved
+        ) d GROUP BY phone_number
+    ), updated AS (
+        UPDATE users SET balance = users.balance + deltas.delta
+        FROM deltas WHERE users.phone_number = deltas.phone_number
+    ), logged AS (
+        INSERT INTO actions (user_phone_number, receiver_phone_number, amount, md5)
+        SELECT user_phone_number, receiver_phone_number, amount, %(md5)s FROM moved ORDER BY id
+        RETURNING id
+    )
+    SELECT id, user_phone_number, receiver_phone_number, amount, (SELECT MAX(id) FROM logged) FROM moved
+'''
+
+# Queues text %(texts)s[i] for the chat of phone %(phones)s[i], in that order. Phones without a chat are skipped
+ENQUEUE_FOR_PHONES = '''
+    INSERT INTO outbox (chat_id, text)
+    SELECT a.user_id, m.text
+    FROM unnest(%(phones)s::TEXT[], %(texts)s::TEXT[]) WITH ORDINALITY AS m(phone_number, text, n)
+    JOIN LATERAL (SELECT user_id FROM assoc WHERE assoc.phone_number = m.phone_number LIMIT 1) a ON true
+    ORDER BY m.n
+'''
+
+# Folds actions in (%(last_id)s, %(until_id)s] into ledger_totals and returns the touched phones whose balance disagrees
+RECONCILE_NEW_ACTIONS = '''
+    WITH deltas AS (
+        SELECT phone_number, SUM(delta)::BIGINT AS delta FROM (
+            SELECT user_phone_number AS phone_number, -amount AS delta FROM actions WHERE id > %(last_id)s AND id <= %(until_id)s
+            UNION ALL
+            SELECT receiver_phone_number, amount FROM actions WHERE id > %(last_id)s AND id <= %(until_id)s
+        ) d GROUP BY phone_number
+    ), totals AS (
+        INSERT INTO ledger_totals (phone_number, total)
+        SELECT phone_number, delta FROM deltas
+        ON CONFLICT (phone_number) DO UPDATE SET total = ledger_totals.total + EXCLUDED.total
+        RETURNING phone_number, total
+    )
+    SELECT t.phone_number, u.balance, t.total
+    FROM totals t LEFT JOIN users u ON u.phone_number = t.phone_number
+    WHERE u.balance IS DISTINCT FROM t.total
+    ORDER BY t.phone_number
+'''
+
+# The phones of %(phones)s whose balance disagrees with ledger_totals
+RECONCILE_PHONES = '''
+    SELECT t.phone_number, u.balance, t.total
+    FROM ledger_totals t LEFT JOIN users u ON u.phone_number = t.phone_number
+    WHERE t.phone_number = ANY(%(phones)s) AND u.balance IS DISTINCT FROM t.total
+    ORDER BY t.phone_number
+'''
+
+# Every phone whose balance disagrees with ledger_totals, without touching actions. Users without totals are
+# expected at 0, and phones with totals but no users row are reported with a NULL balance, like RECONCILE_NEW_ACTIONS does
+RECONCILE_ALL_USERS = '''
+    SELECT COALESCE(u.phone_number, t.phone_number), u.balance, COALESCE(t.total, 0)
+    FROM users u FULL OUTER JOIN ledger_totals t ON t.phone_number = u.phone_number
+    WHERE u.balance IS DISTINCT FROM COALESCE(t.total, 0)
+    ORDER BY 1
+'''
+
+# Maintenance checkpoints: create the row if needed, then read it row-locked so concurrent runs take turns
+CLAIM_CHECKPOINT = 'INSERT INTO checkpoints (name) VALUES (%s) ON CONFLICT (name) DO NOTHING'
+LOCK_CHECKPOINT = 'SELECT last_id, state FROM checkpoints WHERE name=%s FOR UPDATE'
+SAVE_CHECKPOINT = 'UPDATE checkpoints SET last_id=%s, state=%s, updated_at=now() WHERE name=%s'
+
+# The next batch of the md5 chain after a checkpoint, bounded by the ids known to be committed
+CHAIN_BATCH = 'SELECT id, md5 FROM actions WHERE id > %s AND id <= %s ORDER BY id LIMIT %s'
@@ -0,0 +1,22 @@
+import time
+from cache import LRUCache
+
+
+class TokenBucket:
+    # Per-key token bucket: rate tokens per second, up to burst saved up. Keys idle long enough to be full again
+    # are the first ones evicted, so maxsize only bounds memory
+    def __init__(self, rate=1.0, burst=5, maxsize=10000):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = LRUCache(maxsize)
+
+    def allow(self, key):
+        # Takes a token if one is available
+        now = time.monotonic()
+        tokens, last = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self._buckets.put(key, (tokens, now))
+            return False
+        self._buckets.put(key, (tokens - 1, now))
+        return True
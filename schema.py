@@ -0,0 +1,166 @@
+# Schema bootstrap shared by DatabaseManager and AsyncDatabaseManager
+
+# Advisory lock key held while bootstrapping, so processes starting together don't race on DDL
+BOOTSTRAP_LOCK = 0x62617274
+
+TABLES = [
+    # Create the users table if it does not exist
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        id SERIAL PRIMARY KEY,
+        phone_number TEXT NOT NULL,
+        balance BIGINT NOT NULL
+    )
+    ''',
+
+    # Create the telegram-phone table if it does not exist
+    '''
+    CREATE TABLE IF NOT EXISTS assoc (
+        user_id BIGINT NOT NULL PRIMARY KEY,
+        phone_number TEXT NOT NULL
+    )
+    ''',
+
+    # Create the pending_actions table if it does not exist
+    '''
+    CREATE TABLE IF NOT EXISTS pending_actions (
+        id SERIAL PRIMARY KEY,
+        user_phone_number TEXT NOT NULL,
+        receiver_phone_number TEXT NOT NULL,
+        amount BIGINT NOT NULL,
+        comment TEXT NOT NULL
+    )
+    ''',
+
+    # Create the actions table if it does not exist
+    '''
+    CREATE TABLE IF NOT EXISTS actions (
+        id SERIAL PRIMARY KEY,
+        user_phone_number TEXT NOT NULL,
+        receiver_phone_number TEXT NOT NULL,
+        amount BIGINT NOT NULL,
+        md5 TEXT NOT NULL
+    )
+    ''',
+
+    # Applied migration versions, see MIGRATIONS
+    '''
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    ''',
+]
+
+# Versioned changes applied once, in order, on top of TABLES. Never edit an entry once released, append a new one
+MIGRATIONS = [
+    (1, [
+        # Duplicate users could only come from the get_user/add_user race in phone_auth. Balance updates
+        # always hit every row of a phone, so the copies are identical and keeping the oldest one is lossless
+        'DELETE FROM users a USING users b WHERE a.phone_number = b.phone_number AND a.id > b.id',
+        'CREATE UNIQUE INDEX IF NOT EXISTS users_phone_number_key ON users (phone_number)',
+        # get_reverse_assoc
+        'CREATE INDEX IF NOT EXISTS assoc_phone_number_idx ON assoc (phone_number)',
+    ]),
+    (2, [
+        # Outgoing Telegram messages, drained by notifier.Notifier
+        '''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id BIGSERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            text TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS outbox_next_attempt_at_idx ON outbox (next_attempt_at)',
+    ]),
+    (3, [
+        # Announce the new chain head on every insert into actions, see AsyncDatabaseManager.start_listener()
+        '''
+        CREATE OR REPLACE FUNCTION notify_actions_head() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('actions_head', (SELECT id || ':' || md5 FROM new_rows ORDER BY id DESC LIMIT 1));
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        'DROP TRIGGER IF EXISTS actions_head_notify ON actions',
+        '''
+        CREATE TRIGGER actions_head_notify AFTER INSERT ON actions
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_actions_head()
+        ''',
+    ]),
+    (4, [
+        # High-water marks of incremental maintenance jobs, see maintenance.py
+        '''
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            name TEXT PRIMARY KEY,
+            last_id BIGINT NOT NULL DEFAULT 0,
+            state TEXT,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        ''',
+        # Per-phone balance implied by the actions ledger, up to the 'balances' checkpoint
+        '''
+        CREATE TABLE IF NOT EXISTS ledger_totals (
+            phone_number TEXT PRIMARY KEY,
+            total BIGINT NOT NULL DEFAULT 0
+        )
+        ''',
+    ]),
+    (5, [
+        # Bot conversation state (context.user_data), see persistence.PostgresPersistence
+        '''
+        CREATE TABLE IF NOT EXISTS bot_user_data (
+            user_id BIGINT PRIMARY KEY,
+            data JSONB NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS bot_user_data_updated_at_idx ON bot_user_data (updated_at)',
+    ]),
+    (6, [
+        # Announce the phones whose balance changed, comma separated and chunked to stay under the payload limit,
+        # see the balance cache in AsyncDatabaseManager
+        '''
+        CREATE OR REPLACE FUNCTION notify_balances() RETURNS trigger AS $$
+        DECLARE
+            phones TEXT;
+        BEGIN
+            FOR phones IN
+                SELECT string_agg(phone_number, ',') FROM (
+                    SELECT n.phone_number, (row_number() OVER () - 1) / 400 AS chunk
+                    FROM new_rows n JOIN old_rows o ON o.id = n.id
+                    WHERE n.balance IS DISTINCT FROM o.balance
+                ) changed GROUP BY chunk
+            LOOP
+                PERFORM pg_notify('balances', phones);
+            END LOOP;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        'DROP TRIGGER IF EXISTS balances_notify ON users',
+        '''
+        CREATE TRIGGER balances_notify AFTER UPDATE ON users
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_balances()
+        ''',
+    ]),
+    (7, [
+        # Statement triggers also fire for inserts of zero rows (approving ids that are already gone),
+        # which sent an empty actions_head payload
+        '''
+        CREATE OR REPLACE FUNCTION notify_actions_head() RETURNS trigger AS $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM new_rows) THEN
+                PERFORM pg_notify('actions_head', (SELECT id || ':' || md5 FROM new_rows ORDER BY id DESC LIMIT 1));
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+    ]),
+]